@@ -5,44 +5,183 @@
 #    python src/assistant.py
 #        -v | --verbose : verbose mode
 #        -rebuild : forces rebuild of model
+#        --ingest : rebuilds by streaming chunks straight from the PDFs
+#        --min-year, --max-year, --exclude-years : only search those years
+#        --batch FILE : answer the questions in FILE (one per line)
+#                       non-interactively, writing JSONL to --output
+#        --no-cache : don't reuse (or store) cached answers
+#        --warm-cache FILE : pre-generate RAG answers to the questions
+#                            in FILE into the LLM cache, and exit
+#        --lookup TERMS : keyword (BM25) search for TERMS, without
+#                         loading any model, and exit
+#        --profile [FILE] : write a JSONL trace of each stage (timings,
+#                           item counts, peak memory) and print
+#                           p50/p95/p99 timings per stage at exit
 # Configure in src/assistant_config.py
 # Helper functions in src/utils/assistant_utils.py and src/utils/rag_helper.py
 #
 # Author: Katharine Leney, April 2025
 # ==================================================================
 
-from sentence_transformers import SentenceTransformer
 import warnings
 import random
 import argparse
+import json
+import time
 import os
-from assistant_config import EMBEDDING_MODEL, TOP_K, TAKEOFF_MESSAGES, EXIT_MESSAGES, RAG_MODE
-from utils.assistant_helpers import load_or_build_index
-from utils.retrieval_helpers import load_summariser, summarise_texts, ask_question
-from utils.rag_helpers import handle_query_with_rag
+from assistant_config import TOP_K, TAKEOFF_MESSAGES, EXIT_MESSAGES, RAG_MODE
+from assistant_config import RAG_MODEL, SUMMARISER_MODEL, MODEL_PRECISION, ANSWER_CACHE, PROFILE_TRACE_FILE
+from utils.assistant_helpers import load_or_build_index, newer_index_available, open_current_index
+from utils.index_helpers import encode_queries, retrieve, year_mask, attached_lexical_index
+from utils.answer_cache import load_answer_cache, cache_context, lookup_answer, store_answer
+from utils.model_manager import get_embedding_model, get_summariser, start_warmup
+from utils.retrieval_helpers import summarise_map_reduce, summarise_texts_map_reduce, ask_question, rank_results
+from utils.rag_helpers import handle_query_with_rag, agenerate_answers, run_async, warm_llm_cache
+from utils.context_packer import pack_context
+from utils.tracing import trace_stage, start_trace
 
 # Suppress annoying (but harmless!) transformer warnings
 # Investigate this more later...
 warnings.filterwarnings("ignore", category=UserWarning, module="transformers.pytorch_utils")
 
+# ---------------------------------
+# Batch mode: answer every question in
+# queries_file (one per line), retrieving
+# for all of them in a single encode and
+# search, and write one JSON line per
+# question to output_file
+# cache = answer cache (None = don't use)
+# ---------------------------------
+def run_batch(queries_file, output_file, model, index, texts, years, rag_mode, year_filter,
+              cache=None, context=None):
+
+    with open(queries_file, "r") as f:
+        queries = [line.strip() for line in f if line.strip()]
+    if not queries:
+        print(f"[Warning] No questions found in {queries_file}")
+        return
+
+    summariser = None if rag_mode else get_summariser()
+
+    t0 = time.perf_counter()
+    query_embeddings = encode_queries(model, queries)
+    hits = retrieve(model, index, queries, TOP_K, mask=year_mask(years, **year_filter),
+                    query_embeddings=query_embeddings)
+    retrieval_time = time.perf_counter() - t0
+
+    # Cached answers, then (in RAG mode) generate the rest
+    # concurrently, up to RAG_CONCURRENCY requests at a time
+    cached = [lookup_answer(cache, e, context) if cache is not None else None for e in query_embeddings]
+    generated, packing = {}, {}
+    if rag_mode:
+        todo = [j for j, hit in enumerate(cached) if not hit]
+        packed = [pack_context(*hits[j], texts) for j in todo]
+        packing = {j: stats for j, (_, stats) in zip(todo, packed)}
+        answers = run_async(agenerate_answers([queries[j] for j in todo],
+                                              [chunks for chunks, _ in packed]))
+        generated = dict(zip(todo, answers))
+    else:
+        # Summarise the kept matches of every question together
+        # (batched pipeline calls), sharing the time between them
+        todo = [j for j, hit in enumerate(cached) if not hit]
+        t0 = time.perf_counter()
+        answers = summarise_map_reduce([[text for text, year in rank_results(*hits[j], texts, years)]
+                                        for j in todo], summariser)
+        share = (time.perf_counter() - t0) / max(1, len(todo))
+        generated = {j: (answer, share) for j, answer in zip(todo, answers)}
+
+    with open(output_file, "w") as out:
+        for j, (query, query_embedding, (D, I)) in enumerate(zip(queries, query_embeddings, hits)):
+            t0 = time.perf_counter()
+            if cached[j]:
+                answer = cached[j]["answer"]
+            else:
+                answer, _ = generated[j]
+            answer_time = generated[j][1] if j in generated else time.perf_counter() - t0
+
+            if cache is not None and not cached[j] and not answer.startswith("[Fallback]"):
+                store_answer(cache, query, query_embedding, context, answer)
+
+            record = {
+                "query": query,
+                "answer": answer,
+                "cached": bool(cached[j]),
+                "chunk_ids": [int(i) for i in I],
+                "years": [int(years[i]) for i in I],
+                "distances": [round(float(d), 4) for d in D],
+                # (retrieval is done for the whole batch at once,
+                # so each query gets an equal share of its time)
+                "retrieval_s": round(retrieval_time / len(queries), 4),
+                "answer_s": round(answer_time, 4),
+            }
+            if j in packing:
+                record["context"] = packing[j]
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            print(f"[{len(record['chunk_ids'])} chunks, {answer_time:.1f}s] {query}")
+
+    print(f"\nAnswered {len(queries)} questions (retrieval {retrieval_time:.2f}s in total). "
+          f"Results written to {output_file}")
+    if packing:
+        print(f"Context packing saved {sum(p['tokens_saved'] for p in packing.values())} prompt tokens")
+
+# ---------------------------------
+# Lexical-only lookup: print the chunks that best
+# match the terms of query by BM25 (no embedding
+# model or summariser needed)
+# ---------------------------------
+def run_lookup(query, index, texts, years, year_filter, k=TOP_K):
+
+    lexical = attached_lexical_index(index)
+    t0 = time.perf_counter()
+    with trace_stage("bm25_search", items=1):
+        scores, ids = lexical.search(query, k, mask=year_mask(years, **year_filter))
+    search_time = time.perf_counter() - t0
+
+    print(f"\n===== Keyword matches for \"{query}\" =====\n")
+    if not len(ids):
+        print("No chunks contain these terms.")
+    for rank, (score, idx) in enumerate(zip(scores, ids), start=1):
+        text = texts[idx]
+        snippet = text[:100].replace('\n', ' ').strip() + ("..." if len(text) > 100 else "")
+        print(f"{rank}. BM25: {score:.2f} | Year: {years[idx]} | Text Snippet: \"{snippet}\"")
+    print(f"\n[{len(ids)} matches in {search_time * 1000:.2f} ms]\n")
+
 # ---------------------------------
 # Main assistant loop
 # ---------------------------------
 def main():
 
+    start_time = time.perf_counter()
+
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Run the Aviation Assistant")
     parser.add_argument('--rebuild', action='store_true', help='Force rebuild of the FAISS index and text store')
+    parser.add_argument('--ingest', action='store_true', help='Rebuild by streaming chunks straight from the PDFs (extract, embed and index in batches)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose mode (show top match distances)')
+    parser.add_argument('--min-year', type=int, default=None, help='Only search documents from this year onwards')
+    parser.add_argument('--max-year', type=int, default=None, help='Only search documents up to this year')
+    parser.add_argument('--exclude-years', type=int, nargs='+', default=None, help='Years to leave out of the search')
+    parser.add_argument('--batch', metavar='FILE', default=None, help='Answer the questions in FILE (one per line) and exit')
+    parser.add_argument('--output', default=None, help='JSONL output file for --batch (default: FILE with _answers.jsonl)')
+    parser.add_argument('--no-cache', action='store_true', help="Don't reuse or store cached answers")
+    parser.add_argument('--warm-cache', metavar='FILE', default=None, help='Pre-generate RAG answers to the questions in FILE into the LLM cache and exit')
+    parser.add_argument('--lookup', metavar='TERMS', nargs='+', default=None, help='Keyword (BM25) search for TERMS without loading any model, and exit')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const=PROFILE_TRACE_FILE, default=None, help='Write a JSONL trace of each stage to FILE and print p50/p95/p99 timings at exit')
     args = parser.parse_args()
 
+    if args.profile:
+        start_trace(args.profile)
+
     force_rebuild = args.rebuild    
     verbose_mode = args.verbose
+    year_filter = dict(min_year=args.min_year, max_year=args.max_year, exclude_years=args.exclude_years)
 
-    print("\nLoading models and data...")
-    model = SentenceTransformer(EMBEDDING_MODEL)
-    index, texts, years = load_or_build_index(model, force_rebuild=force_rebuild)
-    #summariser = load_summariser()
+    # Exact-term lookups only need the lexical index and the texts
+    if args.lookup:
+        index, texts, years = load_or_build_index(force_rebuild=force_rebuild, stream_from_pdfs=args.ingest)
+        run_lookup(" ".join(args.lookup), index, texts, years, year_filter)
+        return
 
     # Check if the OpenAI key is set if the user is in RAG mode
     # (doesn't help with checking paid credits... come back to this)
@@ -54,26 +193,96 @@ def main():
             print("[Action] Switching to retrieval mode.\n")
             RAG_MODE = False
 
+    # Load the models in the background (each is loaded only once,
+    # and only the summariser is skipped in RAG mode), so they are
+    # warming up while the index loads and the first question is typed
+    print("\nLoading models and data...")
+    start_warmup(["embedding"] if RAG_MODE else ["embedding", "summariser"])
+    index, texts, years = load_or_build_index(force_rebuild=force_rebuild, stream_from_pdfs=args.ingest)
+
+    # Answers to earlier questions, reused for repeated or
+    # paraphrased ones asked in the same mode and year range
+    cache = load_answer_cache() if ANSWER_CACHE and not args.no_cache else None
+    mode = f"rag:{RAG_MODEL}" if RAG_MODE else f"retrieval:{SUMMARISER_MODEL}:{MODEL_PRECISION}"
+    context = cache_context(mode, **year_filter)
+
+    if args.warm_cache:
+        if not RAG_MODE:
+            print("[Error] --warm-cache needs RAG mode (and an OpenAI API key).")
+            return
+        with open(args.warm_cache, "r") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        warm_llm_cache(queries, get_embedding_model(), index, texts, years=years, **year_filter)
+        return
+
+    if args.batch:
+        output_file = args.output or os.path.splitext(args.batch)[0] + "_answers.jsonl"
+        run_batch(args.batch, output_file, get_embedding_model(), index, texts, years, RAG_MODE, year_filter,
+                  cache=cache, context=context)
+        return
+
     print("\n" + random.choice(TAKEOFF_MESSAGES))
+    first_answer = True
     while True:
         query = input("Ask your question (or type 'exit'): ")
         if query.lower() in ['exit', 'quit']:
             print("\n" + random.choice(EXIT_MESSAGES))
             break
 
-        # If RAG_MODE is enabled, use that, otherwise revert to
-        # the retrieval-only method using the summariser
-        if RAG_MODE :
-            answer = handle_query_with_rag(query, model, index, texts)
-        else :
-            summariser = load_summariser()
-            results = ask_question(model, index, texts, years, query, top_k=TOP_K, verbose=verbose_mode)
-            retrieved_texts = [text for text, year in results]
-            answer = summarise_texts(retrieved_texts, summariser)
-
-        print("\n===== Assistant's Answer =====\n")
-        print(answer)
+        query_time = time.perf_counter()
+        # (the whole question, end to end)
+        with trace_stage("question", items=1) as stage:
+            model = get_embedding_model()
+
+            # Switch to a newer index if one has been built meanwhile
+            # (e.g. by --rebuild or --ingest in another process)
+            if newer_index_available(texts):
+                index, texts, years = open_current_index()
+                print("[Switched to the newly built index]")
+                if cache is not None:
+                    cache = load_answer_cache()
+
+            # Reuse the answer to an earlier, similar question if there is one
+            query_embedding = encode_queries(model, [query])[0]
+            cached = lookup_answer(cache, query_embedding, context) if cache is not None else None
+
+            # If RAG_MODE is enabled, use that (streaming the answer
+            # as it is generated), otherwise revert to the
+            # retrieval-only method using the summariser
+            streamed = False
+            if cached :
+                answer = cached["answer"]
+                if verbose_mode:
+                    print(f"\n(Cached answer to: \"{cached['query']}\")")
+            elif RAG_MODE :
+                print("\n===== Assistant's Answer =====\n")
+                answer = handle_query_with_rag(query, model, index, texts, years=years,
+                                               query_embedding=query_embedding, stream=True,
+                                               verbose=verbose_mode, **year_filter)
+                streamed = True
+            else :
+                summariser = get_summariser()
+                results = ask_question(model, index, texts, years, query, top_k=TOP_K, verbose=verbose_mode,
+                                       query_embedding=query_embedding, **year_filter)
+                retrieved_texts = [text for text, year in results]
+                answer = summarise_texts_map_reduce(retrieved_texts, summariser)
+
+            # (Fallback answers are not cached, so the question
+            # is tried again next time)
+            if cache is not None and not cached and not answer.startswith("[Fallback]"):
+                store_answer(cache, query, query_embedding, context, answer)
+            stage.set(cached=bool(cached))
+
+        if not streamed:
+            print("\n===== Assistant's Answer =====\n")
+            print(answer)
         print("\n==============================\n")
 
+        if first_answer:
+            now = time.perf_counter()
+            print(f"[Time to first answer: {now - query_time:.1f}s after asking, "
+                  f"{now - start_time:.1f}s after startup]\n")
+            first_answer = False
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
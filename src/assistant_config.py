@@ -11,18 +11,27 @@ import os
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 MODEL_DIR = os.path.join(BASE_DIR, "models", "assistant")
-
-# ---------------------------------
-# Ensure MODEL_DIR exists
-# ---------------------------------
-os.makedirs(MODEL_DIR, exist_ok=True)
+EMBEDDING_STORE_DIR = os.path.join(BASE_DIR, "models", "embeddings")
 
 # ---------------------------------
 # Key files
 # ---------------------------------
 CHUNKS_FILE = os.path.join(DATA_DIR, "chunks.json")
-INDEX_FILE = os.path.join(MODEL_DIR, "faiss_index.idx")
-TEXTS_FILE = os.path.join(MODEL_DIR, "texts_and_years.json")
+PDF_DIR = os.path.join(DATA_DIR, "annual_reviews")
+INDEX_VERSIONS_DIR = os.path.join(MODEL_DIR, "index_versions") # One subdirectory per index build
+CURRENT_INDEX_FILE = os.path.join(MODEL_DIR, "current_index") # Name of the index version in use (switched atomically)
+ANSWER_CACHE_FILE = os.path.join(MODEL_DIR, "answer_cache.json")
+LLM_CACHE_DIR = os.path.join(MODEL_DIR, "llm_cache")
+PROFILE_TRACE_FILE = os.path.join(BASE_DIR, "models", "profile_trace.jsonl") # Default trace file for --profile
+
+# Files in each index version directory
+# (older builds kept them in MODEL_DIR itself, and are moved on load)
+INDEX_FILE_NAME = "faiss_index.idx"
+TEXTS_FILE_NAME = "texts.bin"
+TEXT_OFFSETS_FILE_NAME = "texts_offsets.npy"
+YEARS_FILE_NAME = "years.npy"
+LEXICAL_INDEX_NAME = "lexical_index"
+LEGACY_TEXTS_FILE_NAME = "texts_and_years.json" # Older builds (converted when the index is opened)
 
 # ---------------------------------
 # Run in RAG or Retrieval-only mode
@@ -35,6 +44,56 @@ RAG_MODE = True
 EMBEDDING_MODEL = "all-MiniLM-L6-v2" # rebuild if this is changed
 SUMMARISER_MODEL = "t5-base" # t5-small also an option (no need to rebuild switching these)
 RAG_MODEL = "gpt-3.5-turbo" # Requires setting up an OpenAI API key in your system and an OpenAI account
+MODEL_PRECISION = "fp32" # "fp32", or "int8" for dynamically quantised CPU inference of the embedding (queries) and summariser models
+
+# ---------------------------------
+# Token-budgeted chunking
+# (python src/extract.py --tokens)
+# ---------------------------------
+CHUNK_MAX_TOKENS = 254 # all-MiniLM-L6-v2 reads 256 tokens, including [CLS] and [SEP]
+CHUNK_OVERLAP_TOKENS = 0 # Tokens of overlap between adjacent chunks
+
+# ---------------------------------
+# Near-duplicate chunk removal
+# (applied before chunks are embedded)
+# ---------------------------------
+DEDUP_CHUNKS = True # Drop near-duplicate chunks (repeated board lists, addresses, rosters) before indexing
+DEDUP_THRESHOLD = 0.8 # Estimated Jaccard similarity above which a chunk counts as a duplicate
+DEDUP_NUM_PERM = 128 # MinHash permutations
+DEDUP_BANDS = 16 # LSH bands (DEDUP_NUM_PERM must divide evenly)
+DEDUP_SHINGLE_SIZE = 5 # Words per shingle
+
+# ---------------------------------
+# Embedding settings
+# ---------------------------------
+EMBED_BATCH_SIZE = 64 # Texts per model.encode batch when building the index
+EMBED_WORKERS = 1 # > 1 to embed with a pool of CPU processes (large corpora only)
+NORMALISE_EMBEDDINGS = True # L2-normalise document and query vectors (rebuild if this is changed)
+
+# ---------------------------------
+# FAISS index settings
+# (rebuild with --rebuild after changing the type or metric)
+# ---------------------------------
+INDEX_TYPE = "flat" # "flat" (exact), "hnsw", "ivf_flat" or "ivf_pq"
+INDEX_METRIC = "l2" # "l2" or "ip" (inner product = cosine with NORMALISE_EMBEDDINGS)
+HNSW_M = 32 # Graph neighbours per node (more = better recall, more memory)
+HNSW_EF_CONSTRUCTION = 200 # Candidate list size while building the graph
+HNSW_EF_SEARCH = 64 # Candidate list size per query (recall vs latency)
+IVF_NLIST = None # Number of inverted lists (None = 4 * sqrt(number of chunks))
+IVF_NPROBE = 8 # Lists scanned per query (recall vs latency)
+PQ_M = 48 # Sub-quantisers per vector for ivf_pq (must divide the embedding dimension)
+PQ_NBITS = 8 # Bits per sub-quantiser code
+INDEX_TRAIN_SIZE = 20000 # Chunks buffered to train IVF indexes during streaming ingest
+INDEX_KEEP_VERSIONS = 2 # Index builds kept on disk (the one in use, and the previous for running processes)
+INDEX_POLL_SECONDS = 5 # How often the query service checks for a newly built index
+
+# ---------------------------------
+# Streaming ingest settings
+# (python src/assistant.py --ingest)
+# ---------------------------------
+INGEST_BATCH_SIZE = 256 # Chunks embedded and added to the index per batch
+INGEST_PREFETCH = 4 # Batches of parsed chunks buffered ahead of the embedder
+INGEST_PUBLISH_EVERY = 20 # Batches between publishing the partial index, so it can be searched during a first ingest (0 = only when complete)
 
 # ---------------------------------
 # Retrieval settings
@@ -42,6 +101,71 @@ RAG_MODEL = "gpt-3.5-turbo" # Requires setting up an OpenAI API key in your syst
 TOP_K = 10 # Number of "top matches" to pass to function that evaluates how many text snippets should be summarised
 THRESHOLD = 0.1 # "Gap" setting for determining cut-off point for clustering of text snippets
 
+# ---------------------------------
+# Summariser settings (retrieval-only mode)
+# ---------------------------------
+SUMMARISER_BATCH_SIZE = 8 # Snippets summarised per batch in one pipeline call
+SUMMARY_MAP_LENGTH = 60 # Maximum tokens in the summary of each snippet
+SUMMARY_MAX_LENGTH = 150 # Maximum tokens in the final answer
+SUMMARY_MAX_CHARS = 2000 # Longest text the summariser is given at once (snippet or joined partial summaries)
+
+# ---------------------------------
+# Lexical (BM25) and hybrid retrieval settings
+# ---------------------------------
+HYBRID_SEARCH = True # Fuse BM25 keyword matches with the FAISS results (helps with acronyms: SAF, NDC, CORSIA...)
+HYBRID_CANDIDATES = 50 # Results taken from each of FAISS and BM25 before fusing
+RRF_K = 60 # Reciprocal rank fusion constant (higher = flatter weighting of ranks)
+BM25_K1 = 1.5 # BM25 term-frequency saturation
+BM25_B = 0.75 # BM25 document-length normalisation
+
+# ---------------------------------
+# RAG context settings
+# (TOP_K chunks are retrieved, then packed into the prompt)
+# ---------------------------------
+RAG_CONTEXT_TOKENS = 1500 # Token budget for the retrieved context in the prompt (LLM tokenizer)
+RAG_DUPLICATE_THRESHOLD = 0.5 # Word-shingle Jaccard similarity above which a chunk is left out as a repeat
+RAG_MIN_OVERLAP_WORDS = 8 # Shortest run of words repeated from a neighbouring chunk that is trimmed
+
+# ---------------------------------
+# RAG generation settings
+# ---------------------------------
+RAG_CONCURRENCY = 4 # Maximum LLM requests in flight at once (--batch)
+RAG_TIMEOUT = 30 # Seconds allowed per LLM request before retrying
+RAG_RETRIES = 3 # Retries (with exponential backoff) before falling back to the retrieved context
+RAG_BACKOFF = 1.0 # Seconds before the first retry (doubled for each further retry)
+RAG_TEMPERATURE = 0.2 # LLM sampling temperature
+RAG_MAX_TOKENS = 500 # Maximum length of a generated answer (in tokens)
+
+# ---------------------------------
+# LLM cache settings
+# (identical prompts are answered from disk)
+# ---------------------------------
+LLM_CACHE = True # Cache LLM answers on disk
+LLM_CACHE_TTL_DAYS = 30 # Cached answers older than this are regenerated
+LLM_CACHE_MAX_ENTRIES = 5000 # Least recently used answers are removed beyond this
+LLM_CACHE_EVICT_TO = 0.9 # Fraction of LLM_CACHE_MAX_ENTRIES kept when the cache overflows
+
+# ---------------------------------
+# Answer cache settings
+# (reuse answers to repeated or paraphrased questions)
+# ---------------------------------
+ANSWER_CACHE = True # Cache answers (cleared automatically when the index is rebuilt)
+ANSWER_CACHE_SIMILARITY = 0.95 # Cosine similarity above which a question counts as already answered
+ANSWER_CACHE_MAX_ENTRIES = 1000 # Least recently used answers are dropped beyond this
+ANSWER_CACHE_MAX_AGE_DAYS = 30 # Answers older than this are dropped
+ANSWER_CACHE_SAVE_EVERY = 20 # Changes (new answers, reused answers) before the cache is written to disk...
+ANSWER_CACHE_SAVE_SECONDS = 60 # ...or seconds since it was last written (unsaved changes are also written at exit)
+
+# ---------------------------------
+# Query service settings
+# (python src/assistant_server.py)
+# ---------------------------------
+SERVER_HOST = "localhost" # Address to listen on
+SERVER_PORT = 8080 # Port to listen on
+SERVER_MAX_CONCURRENCY = 32 # Requests handled at once (more are refused with 503)
+SERVER_BATCH_WINDOW = 0.01 # Seconds to wait for concurrent requests to join a batch
+SERVER_MAX_BATCH = 32 # Most queries encoded and searched in one batch
+
 # ---------------------------------
 # Aviation-themed messages
 # for the assistant to use
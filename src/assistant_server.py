@@ -0,0 +1,284 @@
+# ================================================================
+# Local HTTP query service for the assistant.
+# Loads the models and index once and serves any number of clients,
+# rather than one interactive process (and copy of the model and
+# index) per user. Queries arriving together are micro-batched:
+# encoded and searched in one batch (SERVER_BATCH_WINDOW,
+# SERVER_MAX_BATCH), and in retrieval-only mode summarised in one
+# batch. At most SERVER_MAX_CONCURRENCY requests are handled at
+# once; more are refused with 503.
+# A newly built index (e.g. python src/assistant.py --rebuild) is
+# picked up within INDEX_POLL_SECONDS and swapped in without a
+# restart: requests already being answered finish on the old one.
+#
+# Endpoints (JSON):
+#    GET  /health   : status, index version and size, load and batching stats
+#    POST /retrieve : {"query": ..., "top_k": 10, "min_year": ...,
+#                      "max_year": ..., "exclude_years": [...]}
+#                     -> best-matching chunks with years and distances
+#    POST /ask      : as /retrieve, plus optional "mode" ("rag" or
+#                     "retrieval") -> answer
+#
+# Usage:
+#    python src/assistant_server.py [--host localhost] [--port 8080]
+#                                   [--profile [FILE]]
+# then e.g.:
+#    curl -s localhost:8080/ask -d '{"query": "What is CORSIA?"}'
+# ================================================================
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from assistant_config import TOP_K, RAG_MODE, RAG_CONCURRENCY, SERVER_HOST, SERVER_PORT, SERVER_MAX_CONCURRENCY
+from assistant_config import INDEX_POLL_SECONDS, PROFILE_TRACE_FILE
+from utils.assistant_helpers import load_or_build_index, newer_index_available, open_current_index
+from utils.context_packer import pack_context
+from utils.index_helpers import encode_queries, retrieve, year_mask
+from utils.micro_batcher import MicroBatcher
+from utils.model_manager import get_embedding_model, get_summariser, start_warmup
+from utils.rag_helpers import agenerate_answer
+from utils.retrieval_helpers import rank_results, summarise_map_reduce
+from utils.tracing import trace_stage, start_trace
+
+# ----------------------------------------------------------------
+# Error with the HTTP status to answer with
+# ----------------------------------------------------------------
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# ----------------------------------------------------------------
+# Query parameters from a request body
+# ----------------------------------------------------------------
+def parse_query(body):
+    query = body.get("query")
+    if not isinstance(query, str) or not query.strip():
+        raise RequestError(400, "'query' must be a non-empty string")
+    try:
+        return {
+            "query": query.strip(),
+            "top_k": max(1, int(body.get("top_k", TOP_K))),
+            "min_year": None if body.get("min_year") is None else int(body["min_year"]),
+            "max_year": None if body.get("max_year") is None else int(body["max_year"]),
+            "exclude_years": tuple(int(y) for y in body.get("exclude_years") or ()),
+        }
+    except (TypeError, ValueError):
+        raise RequestError(400, "'top_k' and the year filters must be integers")
+
+
+class AssistantService:
+
+    def __init__(self, rag_mode):
+        self.rag_mode = rag_mode
+        # (index, texts, years), replaced as a whole when a new
+        # index is built, so each request sees one consistent set
+        self.state = load_or_build_index()
+        threading.Thread(target=self.watch_index, name="index-watcher", daemon=True).start()
+
+        self.retriever = MicroBatcher(self.retrieve_batch, name="retrieval")
+        self.summariser = MicroBatcher(lambda text_lists: summarise_map_reduce(text_lists, get_summariser()),
+                                       name="summariser")
+
+        self.slots = threading.BoundedSemaphore(SERVER_MAX_CONCURRENCY)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        # LLM requests from every client run on one event loop,
+        # so RAG_CONCURRENCY limits them all together
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="generation", daemon=True).start()
+        self.llm_slots = asyncio.Semaphore(RAG_CONCURRENCY)
+
+    # ------------------------------------------------------------
+    # Swap in newly built index versions as they are published
+    # ------------------------------------------------------------
+    def watch_index(self, interval=INDEX_POLL_SECONDS):
+        while True:
+            time.sleep(interval)
+            try:
+                if newer_index_available(self.state[1]):
+                    self.state = open_current_index()
+                    print(f"Switched to new index version ({len(self.state[1])} chunks)")
+            except Exception as e:
+                print(f"[Warning] Could not load the new index version: {e}")
+
+    # ------------------------------------------------------------
+    # Retrieve for a batch of queries (parse_query dicts): one
+    # encode for the batch, and one search per distinct top_k and
+    # year filter. Returns (distances, ids, texts, years) for each.
+    # ------------------------------------------------------------
+    def retrieve_batch(self, items):
+        index, texts, years = self.state
+        queries = [item["query"] for item in items]
+        query_embeddings = encode_queries(get_embedding_model(), queries)
+
+        groups = defaultdict(list)
+        for j, item in enumerate(items):
+            groups[(item["top_k"], item["min_year"], item["max_year"], item["exclude_years"])].append(j)
+
+        results = [None] * len(items)
+        for (top_k, min_year, max_year, exclude_years), js in groups.items():
+            mask = year_mask(years, min_year, max_year, list(exclude_years))
+            hits = retrieve(None, index, [queries[j] for j in js], top_k, mask=mask,
+                            query_embeddings=query_embeddings[js])
+            for j, (D, I) in zip(js, hits):
+                results[j] = (D, I, texts, years)
+        return results
+
+    def health(self):
+        return {
+            "status": "ok",
+            "mode": "rag" if self.rag_mode else "retrieval",
+            "index_version": os.path.basename(self.state[1].directory),
+            "chunks": len(self.state[1]),
+            "in_flight": self.in_flight,
+            "max_concurrency": SERVER_MAX_CONCURRENCY,
+            "batches": self.retriever.batches,
+            "mean_batch_size": round(self.retriever.mean_batch_size(), 2),
+        }
+
+    def handle_retrieve(self, body):
+        params = parse_query(body)
+        t0 = time.perf_counter()
+        D, I, texts, years = self.retriever.submit(params)
+        return {
+            "query": params["query"],
+            "results": [{"id": int(i), "year": int(years[i]), "distance": round(float(d), 4), "text": texts[i]}
+                        for d, i in zip(D, I)],
+            "retrieval_s": round(time.perf_counter() - t0, 4),
+        }
+
+    def handle_ask(self, body):
+        params = parse_query(body)
+        mode = body.get("mode") or ("rag" if self.rag_mode else "retrieval")
+        if mode not in ("rag", "retrieval"):
+            raise RequestError(400, "'mode' must be 'rag' or 'retrieval'")
+        if mode == "rag" and not self.rag_mode:
+            raise RequestError(400, "RAG mode needs an OpenAI API key (OPENAI_API_KEY)")
+
+        t0 = time.perf_counter()
+        D, I, texts, years = self.retriever.submit(params)
+        retrieval_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        if mode == "rag":
+            chunks, _ = pack_context(D, I, texts)
+            answer = asyncio.run_coroutine_threadsafe(
+                agenerate_answer(params["query"], chunks, self.llm_slots), self.loop).result()
+        else:
+            results = rank_results(D, I, texts, years)
+            answer = self.summariser.submit([text for text, year in results])
+
+        return {
+            "query": params["query"],
+            "answer": answer,
+            "mode": mode,
+            "chunk_ids": [int(i) for i in I],
+            "years": [int(years[i]) for i in I],
+            "distances": [round(float(d), 4) for d in D],
+            "retrieval_s": round(retrieval_time, 4),
+            "answer_s": round(time.perf_counter() - t0, 4),
+        }
+
+
+def make_handler(service):
+
+    routes = {
+        ("GET", "/health"): lambda body: service.health(),
+        ("POST", "/retrieve"): service.handle_retrieve,
+        ("POST", "/ask"): service.handle_ask,
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, data):
+            payload = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            if status == 503:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def handle_request(self, method):
+            path = self.path.split("?")[0].rstrip("/")
+            route = routes.get((method, path))
+            if route is None:
+                self.send_json(404, {"error": f"No endpoint {method} {self.path}"})
+                return
+
+            # Health checks are answered even when the service is busy
+            limited = method == "POST"
+            if limited and not service.slots.acquire(blocking=False):
+                self.send_json(503, {"error": "Server busy, try again shortly"})
+                return
+            try:
+                if limited:
+                    with service.lock:
+                        service.in_flight += 1
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}") if method == "POST" else {}
+                if not isinstance(body, dict):
+                    raise RequestError(400, "Request body must be a JSON object")
+                with trace_stage("request", endpoint=path):
+                    result = route(body)
+                self.send_json(200, result)
+            except json.JSONDecodeError:
+                self.send_json(400, {"error": "Request body is not valid JSON"})
+            except RequestError as e:
+                self.send_json(e.status, {"error": str(e)})
+            except Exception as e:
+                print(f"[Warning] {method} {self.path} failed: {e}")
+                self.send_json(500, {"error": str(e)})
+            finally:
+                if limited:
+                    with service.lock:
+                        service.in_flight -= 1
+                    service.slots.release()
+
+        def do_GET(self):
+            self.handle_request("GET")
+
+        def do_POST(self):
+            self.handle_request("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve the Aviation Assistant over HTTP")
+    parser.add_argument('--host', default=SERVER_HOST, help=f'Address to listen on (default: {SERVER_HOST})')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help=f'Port to listen on (default: {SERVER_PORT})')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const=PROFILE_TRACE_FILE, default=None, help='Write a JSONL trace of each stage to FILE and print p50/p95/p99 timings on shutdown')
+    args = parser.parse_args()
+
+    if args.profile:
+        start_trace(args.profile)
+
+    rag_mode = RAG_MODE and bool(os.getenv("OPENAI_API_KEY"))
+    if RAG_MODE and not rag_mode:
+        print("[Warning] RAG mode selected but no OpenAI API key found: serving retrieval mode only.")
+
+    print("Loading models and data...")
+    start_warmup(["embedding"] if rag_mode else ["embedding", "summariser"])
+    service = AssistantService(rag_mode)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f"Assistant service on http://{args.host}:{args.port} "
+          f"({'RAG' if rag_mode else 'retrieval'} mode, {len(service.state[1])} chunks)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down")
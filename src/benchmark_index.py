@@ -0,0 +1,108 @@
+# ================================================================
+# Recall and latency harness for the FAISS index types in
+# utils/index_helpers.py.
+# Builds each index type over the corpus embeddings and reports,
+# for the queries in example_prompts.txt:
+#  - recall@k against the exact (flat) index
+#  - p50/p99 single-query search latency
+#  - build time
+# Query-time settings (HNSW_EF_SEARCH, IVF_NPROBE, ...) are read
+# from src/assistant_config.py, so edit them there to explore the
+# recall/latency trade-off.
+#
+# Usage:
+#    python src/benchmark_index.py [--k 10] [--repeat 20] [--metric l2|ip]
+#                                  [--types flat hnsw ivf_flat ivf_pq]
+# ================================================================
+
+import os
+import time
+import argparse
+import numpy as np
+from assistant_config import BASE_DIR, CHUNKS_FILE, EMBEDDING_MODEL, INDEX_METRIC
+from assistant_config import DEDUP_CHUNKS, NORMALISE_EMBEDDINGS, TOP_K
+from utils.index_helpers import INDEX_TYPES, build_faiss_index, search_index
+from utils.index_versions import current_version, version_dir
+from utils.text_store import text_store_exists, open_text_store
+
+QUERIES_FILE = os.path.join(BASE_DIR, "example_prompts.txt")
+
+# ----------------------------------------------------------------
+# Texts the assistant indexes: the saved index texts if there are
+# any, otherwise data/chunks.json
+# ----------------------------------------------------------------
+def load_texts():
+    version = current_version()
+    if version is not None and text_store_exists(version_dir(version)):
+        texts, _ = open_text_store(version_dir(version))
+        return list(texts)
+
+    from utils.assistant_helpers import load_chunks
+    texts, _ = load_chunks(CHUNKS_FILE, dedup=DEDUP_CHUNKS)
+    return texts
+
+# ----------------------------------------------------------------
+# One query per non-empty line
+# ----------------------------------------------------------------
+def load_queries(path):
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+# ----------------------------------------------------------------
+# Fraction of the exact top-k found by the approximate search,
+# averaged over queries
+# ----------------------------------------------------------------
+def recall_at_k(exact_ids, approx_ids):
+    hits = [len(set(e[e >= 0]) & set(a[a >= 0])) / max(1, np.sum(e >= 0))
+            for e, a in zip(exact_ids, approx_ids)]
+    return float(np.mean(hits))
+
+# ----------------------------------------------------------------
+# Search one query at a time (as the assistant does) and return
+# the latencies in milliseconds
+# ----------------------------------------------------------------
+def query_latencies(index, query_embeddings, k, repeat):
+    latencies = []
+    for _ in range(repeat):
+        for q in query_embeddings:
+            t0 = time.perf_counter()
+            search_index(index, q, k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+    return np.array(latencies)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark recall and latency of the FAISS index types")
+    parser.add_argument('--k', type=int, default=TOP_K, help=f'Number of neighbours (default: {TOP_K})')
+    parser.add_argument('--repeat', type=int, default=20, help='Times each query is timed (default: 20)')
+    parser.add_argument('--metric', choices=["l2", "ip"], default=INDEX_METRIC, help='Index metric')
+    parser.add_argument('--types', nargs="+", choices=INDEX_TYPES, default=INDEX_TYPES, help='Index types to compare')
+    parser.add_argument('--queries', default=QUERIES_FILE, help='Text file of queries, one per line')
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    from utils.embedding_store import get_embeddings
+
+    model = SentenceTransformer(EMBEDDING_MODEL)
+    texts = load_texts()
+    embeddings = get_embeddings(model, texts)
+    queries = load_queries(args.queries)
+    query_embeddings = model.encode(queries, convert_to_numpy=True,
+                                    normalize_embeddings=NORMALISE_EMBEDDINGS).astype(np.float32)
+    print(f"{len(texts)} chunks, {len(queries)} queries, k={args.k}, metric={args.metric}")
+
+    exact_index = build_faiss_index(embeddings, index_type="flat", metric=args.metric)
+    _, exact_ids = search_index(exact_index, query_embeddings, args.k)
+
+    print(f"{'index':<10}{'build (s)':>11}{'recall@' + str(args.k):>11}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for index_type in args.types:
+        t0 = time.perf_counter()
+        index = build_faiss_index(embeddings, index_type=index_type, metric=args.metric)
+        t_build = time.perf_counter() - t0
+
+        _, ids = search_index(index, query_embeddings, args.k)
+        latencies = query_latencies(index, query_embeddings, args.k, args.repeat)
+
+        print(f"{index_type:<10}{t_build:>11.2f}{recall_at_k(exact_ids, ids):>11.3f}"
+              f"{np.percentile(latencies, 50):>10.3f}{np.percentile(latencies, 99):>10.3f}")
@@ -0,0 +1,153 @@
+# ================================================================
+# Micro-benchmark of the page normalisation in
+# extract.py (normalise_page) against the original multi-pass
+# functions it replaces. Checks the outputs are identical (on
+# random strings built from the characters the cleaning treats
+# specially, then on the real pages) and reports start-up and
+# per-page timings.
+# Usage:
+#    python src/benchmark_normalise.py [--max-pages N] [--repeat N] [--fuzz N]
+# Uses the raw page text of the PDFs in data/annual_reviews, or
+# falls back to the texts in data/chunks.json if none are found
+# (without either, only the random strings are checked).
+# ================================================================
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import unicodedata
+import timeit
+
+import extract
+from extract import ROOT, normalise_page
+
+# ----------------------------------------------------------------
+# Original implementation, kept here as the reference
+# ----------------------------------------------------------------
+def reference_punct_chars():
+    return {chr(i) for i in range(sys.maxunicode)
+            if unicodedata.category(chr(i)).startswith("P")}
+
+def reference_remove_single_letter_tokens(text, punct):
+    out = []
+    for tok in text.split():
+        start, end = 0, len(tok)
+        while start < end and tok[start] in punct:
+            start += 1
+        while end > start and tok[end-1] in punct:
+            end -= 1
+        core = tok[start:end]
+        if len(core) == 1 and core.isalpha():
+            continue
+        out.append(tok)
+    return " ".join(out)
+
+def reference_clean_pdf_text(text):
+    text = text.replace("’", "'")
+    text = re.sub(r"\b(\w+)'s\b", r"\1", text, flags=re.IGNORECASE)
+    return text
+
+def reference_paragraphs(pages, punct):
+    full_text = ""
+    for text in pages:
+        text = reference_clean_pdf_text(text)
+        text = text.replace("-\n", "")
+        text = text.replace("\n", " ")
+        full_text += text + "\n\n"
+
+    paragraphs = [p.strip() for p in full_text.split("\n\n") if p.strip()]
+    return [reference_remove_single_letter_tokens(para.strip(" ,.-–—‘“”\""), punct)
+            for para in paragraphs]
+
+# ----------------------------------------------------------------
+# Collect raw page texts to benchmark on
+# ----------------------------------------------------------------
+def load_pages(max_pages):
+    pdf_dir = os.path.join(ROOT, "data", "annual_reviews")
+    pages = []
+    if os.path.isdir(pdf_dir):
+        import fitz
+        for fname in extract.list_pdfs(pdf_dir):
+            with fitz.open(os.path.join(pdf_dir, fname)) as doc:
+                pages.extend(page.get_text() for page in doc)
+            if len(pages) >= max_pages:
+                break
+    chunks_file = os.path.join(ROOT, "data", "chunks.json")
+    if not pages and os.path.exists(chunks_file):
+        with open(chunks_file, "r") as f:
+            pages = [chunk["text"] for chunk in json.load(f)]
+    return pages[:max_pages]
+
+# ----------------------------------------------------------------
+# Random strings for the equivalence check: apostrophes and the
+# letters case-insensitive matching equates with s (including the
+# long s, ſ), hyphens and newlines, Unicode whitespace, punctuation
+# and underscores, and letters, digits and symbols that are or
+# aren't \w or alphabetic, with the odd random code point
+# ----------------------------------------------------------------
+FUZZ_ALPHABET = ("abxAB" "sSſ" "'’" "-\n\n" "  \t\x1c\u3000" ".,;()\"“”‘–—_" "19²éßǅ+")
+
+def fuzz_pages(n, seed=0, max_length=24):
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(n):
+        chars = [rng.choice(FUZZ_ALPHABET) if rng.random() > 0.02 else chr(rng.randrange(0x20, 0x3000))
+                 for _ in range(rng.randint(0, max_length))]
+        pages.append("".join(chars))
+    return pages
+
+# ----------------------------------------------------------------
+# Check normalise_page against the reference on each page on its
+# own (so a difference points at the page that caused it)
+# ----------------------------------------------------------------
+def check_equivalence(pages, punct):
+    for page in pages:
+        expected = reference_paragraphs([page], punct)
+        got = normalise_page(page)
+        got = [] if got is None else [got]
+        assert got == expected, f"normalise_page output differs from the reference for {page!r}: {got} != {expected}"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark page normalisation in extract.py")
+    parser.add_argument('--max-pages', type=int, default=2000, help='Maximum number of pages to benchmark on')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing repeats (best is reported)')
+    parser.add_argument('--fuzz', type=int, default=200000, help='Number of random strings to check (default: 200000)')
+    args = parser.parse_args()
+
+    pages = load_pages(args.max_pages)
+
+    # Start-up cost: building the punctuation table
+    t0 = time.perf_counter()
+    punct = reference_punct_chars()
+    t_ref_setup = time.perf_counter() - t0
+
+    extract.punct_chars.cache_clear()
+    t0 = time.perf_counter()
+    assert extract.punct_chars() == punct, "Punctuation tables differ"
+    t_new_setup = time.perf_counter() - t0
+
+    # Outputs must be identical
+    check_equivalence(fuzz_pages(args.fuzz), punct)
+    print(f"Outputs identical on {args.fuzz} random strings.")
+    if not pages:
+        print("No PDFs or chunks.json found: nothing to benchmark on")
+        sys.exit(0)
+    print(f"Benchmarking on {len(pages)} pages")
+
+    expected = reference_paragraphs(pages, punct)
+    got = [p for p in (normalise_page(page) for page in pages) if p is not None]
+    assert got == expected, "normalise_page output differs from the reference"
+
+    t_ref = min(timeit.repeat(lambda: reference_paragraphs(pages, punct), number=1, repeat=args.repeat))
+    t_new = min(timeit.repeat(lambda: [normalise_page(page) for page in pages], number=1, repeat=args.repeat))
+
+    print(f"{'':<24}{'reference':>12}{'normalise_page':>16}")
+    print(f"{'punctuation table (s)':<24}{t_ref_setup:>12.4f}{t_new_setup:>16.4f}")
+    print(f"{'pages/s':<24}{len(pages) / t_ref:>12.0f}{len(pages) / t_new:>16.0f}")
+    print("Outputs identical.")
@@ -0,0 +1,108 @@
+# ================================================================
+# Compares the fp32 and int8 (dynamically quantised) embedding and
+# summariser models used by the assistant (MODEL_PRECISION in
+# src/assistant_config.py). For the queries in example_prompts.txt
+# it reports, for each precision:
+#  - model size (serialised weights)
+#  - p50/p99 single-query latency
+#  - embeddings: cosine similarity of the int8 query embeddings to
+#    the fp32 ones, and overlap@k of the chunks they retrieve
+#  - summaries: cosine similarity of the int8 summaries to the fp32
+#    ones (embedded with the fp32 model), for the first few queries
+#
+# Usage:
+#    python src/benchmark_quantisation.py [--k 10] [--repeat 5]
+#                                         [--summaries 5] [--skip-summariser]
+# ================================================================
+
+import io
+import time
+import argparse
+import numpy as np
+from assistant_config import TOP_K
+from benchmark_index import QUERIES_FILE, load_queries, recall_at_k
+from utils.index_helpers import encode_queries, search_index
+from utils.model_manager import PRECISIONS, load_embedding_model, load_summariser_model
+
+# ----------------------------------------------------------------
+# Size in MB of a torch model's saved weights
+# ----------------------------------------------------------------
+def model_size_mb(model):
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+# ----------------------------------------------------------------
+# Run fn on each input (repeat times) and return the results of
+# the first pass and the latencies in milliseconds
+# ----------------------------------------------------------------
+def timed(fn, inputs, repeat):
+    results, latencies = [], []
+    for r in range(repeat):
+        for x in inputs:
+            t0 = time.perf_counter()
+            result = fn(x)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            if r == 0:
+                results.append(result)
+    return results, np.array(latencies)
+
+# ----------------------------------------------------------------
+# Row-wise cosine similarity of two sets of vectors
+# ----------------------------------------------------------------
+def cosine_similarities(a, b):
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return np.sum(a * b, axis=1)
+
+def print_row(name, size, latencies, similarity, extra=""):
+    print(f"{name:<6}{size:>11.1f}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 99):>10.1f}"
+          f"{similarity[0]:>12.4f}{similarity[1]:>12.4f}{extra}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark fp32 against int8 quantised models")
+    parser.add_argument('--k', type=int, default=TOP_K, help=f'Chunks retrieved per query (default: {TOP_K})')
+    parser.add_argument('--repeat', type=int, default=5, help='Times each query is timed (default: 5)')
+    parser.add_argument('--summaries', type=int, default=5, help='Queries to summarise (default: 5)')
+    parser.add_argument('--skip-summariser', action='store_true', help='Only benchmark the embedding model')
+    parser.add_argument('--queries', default=QUERIES_FILE, help='Text file of queries, one per line')
+    args = parser.parse_args()
+
+    from utils.assistant_helpers import load_or_build_index
+    from utils.retrieval_helpers import summarise_texts_map_reduce
+
+    queries = load_queries(args.queries)
+    models = {precision: load_embedding_model(precision) for precision in PRECISIONS}
+    index, texts, _ = load_or_build_index(model=models["fp32"])
+
+    # Embedding model
+    print(f"\nEmbedding model: {len(queries)} queries, k={args.k}")
+    print(f"{'':<6}{'size (MB)':>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'mean cos':>12}{'min cos':>12}"
+          f"{'overlap@' + str(args.k):>12}")
+    embeddings, retrieved = {}, {}
+    for precision, model in models.items():
+        results, latencies = timed(lambda q: encode_queries(model, [q])[0], queries, args.repeat)
+        embeddings[precision] = np.array(results, dtype=np.float32)
+        _, retrieved[precision] = search_index(index, embeddings[precision], args.k)
+        similarity = cosine_similarities(embeddings[precision], embeddings["fp32"])
+        print_row(precision, model_size_mb(model), latencies, (similarity.mean(), similarity.min()),
+                  f"{recall_at_k(retrieved['fp32'], retrieved[precision]):>12.3f}")
+
+    if args.skip_summariser:
+        raise SystemExit
+
+    # Summariser, on the same (fp32-retrieved) chunks for both precisions
+    inputs = [[texts[i] for i in ids if i >= 0] for ids in retrieved["fp32"][:args.summaries]]
+    print(f"\nSummariser: {len(inputs)} queries")
+    print(f"{'':<6}{'size (MB)':>11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'mean cos':>12}{'min cos':>12}")
+    summaries = {}
+    for precision in PRECISIONS:
+        summariser = load_summariser_model(precision)
+        summaries[precision], latencies = timed(lambda t: summarise_texts_map_reduce(t, summariser), inputs, 1)
+        similarity = cosine_similarities(encode_queries(models["fp32"], summaries[precision]),
+                                         encode_queries(models["fp32"], summaries["fp32"]))
+        print_row(precision, model_size_mb(summariser.model), latencies, (similarity.mean(), similarity.min()))
+        del summariser
@@ -0,0 +1,119 @@
+# ================================================================
+# Startup-time regression check for the assistant.
+#  1. Imports assistant.py in a fresh interpreter, timing it, and
+#     fails if the import alone loads any of the heavy modules that
+#     should only be loaded on the code path that uses them.
+#  2. Launches the assistant (with an index already built) and
+#     times how long it takes to show its first prompt, failing if
+#     the median over --runs exceeds --budget seconds.
+# Exits with status 1 on failure, so it can be run in CI; --record
+# appends the timings to a JSONL file to track them over time.
+#
+# Usage:
+#    python src/check_startup.py [--budget 5] [--runs 3]
+#                                [--record startup_times.jsonl]
+# ================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import numpy as np
+from assistant_config import BASE_DIR
+
+SRC_DIR = os.path.join(BASE_DIR, "src")
+PROMPT = b"Ask your question"
+
+# Modules that must not be loaded just by importing the assistant
+HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "openai", "sklearn", "tiktoken", "pandas"]
+
+IMPORT_SCRIPT = f"""
+import sys, json, time
+sys.path.insert(0, {SRC_DIR!r})
+t0 = time.perf_counter()
+import assistant
+print(json.dumps({{"import_s": time.perf_counter() - t0,
+                  "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+# ----------------------------------------------------------------
+# Import the assistant in a fresh interpreter: returns the import
+# time and the heavy modules it loaded
+# ----------------------------------------------------------------
+def check_import():
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True,
+                            text=True, check=True, cwd=BASE_DIR).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return result["import_s"], result["heavy"]
+
+# ----------------------------------------------------------------
+# Launch the assistant and return the seconds until its first
+# prompt (None if it doesn't appear within timeout)
+# ----------------------------------------------------------------
+def time_to_first_prompt(timeout):
+    t0 = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, "assistant.py")], cwd=BASE_DIR,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    prompted = threading.Event()
+
+    def read_output():
+        output = b""
+        while not prompted.is_set():
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                return
+            output += data
+            if PROMPT in output:
+                prompted.set()
+
+    threading.Thread(target=read_output, daemon=True).start()
+    elapsed = time.perf_counter() - t0 if prompted.wait(timeout) else None
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the assistant's startup time")
+    parser.add_argument('--budget', type=float, default=5.0, help='Maximum seconds to the first prompt (default: 5)')
+    parser.add_argument('--runs', type=int, default=3, help='Launches to time (default: 3)')
+    parser.add_argument('--record', metavar='FILE', default=None, help='Append the timings to this JSONL file')
+    args = parser.parse_args()
+
+    from utils.index_versions import current_version
+
+    failed = False
+    import_time, heavy = check_import()
+    print(f"Import: {import_time:.2f}s")
+    if heavy:
+        print(f"[FAIL] Importing assistant.py loads {', '.join(heavy)}")
+        failed = True
+
+    first_prompt = None
+    if current_version() is None:
+        print("[Warning] No index built yet: skipping the time to first prompt "
+              "(run python src/assistant.py --rebuild first)")
+    else:
+        times = [time_to_first_prompt(timeout=max(60.0, 3 * args.budget)) for _ in range(args.runs)]
+        if None in times:
+            print("[FAIL] The assistant did not show its prompt")
+            failed = True
+        else:
+            first_prompt = float(np.median(times))
+            print(f"Time to first prompt: {first_prompt:.2f}s (median of {args.runs}, budget {args.budget:g}s)")
+            if first_prompt > args.budget:
+                print("[FAIL] Startup is slower than the budget")
+                failed = True
+
+    if args.record:
+        with open(args.record, "a") as f:
+            f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "import_s": round(import_time, 3),
+                                "first_prompt_s": None if first_prompt is None else round(first_prompt, 3),
+                                "heavy_imports": heavy}) + "\n")
+
+    print("Startup check " + ("failed" if failed else "passed"))
+    sys.exit(1 if failed else 0)
@@ -11,12 +11,102 @@
 import os
 import fitz  # from PyMuPDF, to open and extract text from pdf files
 import json
+import hashlib
 import re    # regular expressions to extract years from filenames
 import sys
+import time
+import argparse
 import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from collections import deque, Counter
+from assistant_config import EMBEDDING_MODEL, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, PROFILE_TRACE_FILE
+from utils.tracing import trace_stage, trace_iter, start_trace
 
-_PUNCT_CHARS = {chr(i) for i in range(sys.maxunicode)
-                if unicodedata.category(chr(i)).startswith("P")}
+# Number of pages handed to a worker in one go when running in
+# parallel mode. Large reports are split into several page ranges
+# so that a single long file doesn't keep one core busy on its own.
+PAGES_PER_TASK = 16
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+CACHE_DIR = os.path.join(ROOT, ".cache")
+
+# Running headers and footers: lines within the first/last
+# BOILERPLATE_EDGE_LINES lines of a page that recur on at least
+# BOILERPLATE_MIN_FRACTION of a document's pages are stripped
+# (with --strip-boilerplate)
+BOILERPLATE_EDGE_LINES = 3
+BOILERPLATE_MIN_FRACTION = 0.3
+
+# Characters stripped from the start and end of each paragraph
+EDGE_CHARS = " ,.-–—‘“”\""
+
+# Simple possessives: word's --> word
+_POSSESSIVE_RE = re.compile(r"\b(\w+)'s\b", flags=re.IGNORECASE)
+
+# Every 's at the end of a word. Searching for the apostrophe is
+# much faster than trying \b(\w+) at the start of every word, and
+# _drop_possessive checks that it follows a word character.
+# (ſ, the long s, is matched too, as _POSSESSIVE_RE's IGNORECASE does)
+_APOSTROPHE_S_RE = re.compile(r"'[sSſ]\b")
+
+# Possessives stacked back to back (word's's): _POSSESSIVE_RE only
+# removes every other one, which the fast path would not reproduce
+_STACKED_POSSESSIVE_RE = re.compile(r"'[sSſ]'[sSſ]")
+
+# Tokens (with a space in front) that are one word character with
+# only punctuation, symbols or underscores around it: the only
+# tokens that can be single letters. _drop_single_letter decides.
+_SINGLE_CHAR_TOKEN_RE = re.compile(r"\s(?:[^\w\s]|_)*\w(?:[^\w\s]|_)*(?=\s)")
+
+# ----------------------------------------------------------------
+# Set of all Unicode punctuation characters (category P*).
+# Building it means checking every code point, which is slow, so
+# it is built lazily (not at import, which worker processes pay
+# for too) and cached on disk per Unicode version.
+# ----------------------------------------------------------------
+@lru_cache(maxsize=None)
+def punct_chars():
+    cache_file = os.path.join(CACHE_DIR, f"punct_chars_{unicodedata.unidata_version}.json")
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return frozenset(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+    chars = frozenset(chr(i) for i in range(sys.maxunicode)
+                      if unicodedata.category(chr(i)).startswith("P"))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_file, "w", encoding="utf-8") as f:
+            json.dump("".join(sorted(chars)), f)
+    except OSError as e:
+        print(f"[Warning] Could not cache punctuation table: {e}")
+    return chars
+
+# The same characters as a string, for str.strip()
+@lru_cache(maxsize=None)
+def punct_string():
+    return "".join(sorted(punct_chars()))
+
+# ----------------------------------------------------------------
+# Replacement callbacks for the regexes above
+# ----------------------------------------------------------------
+def _drop_possessive(match):
+    start = match.start()
+    prev = match.string[start-1] if start else " "
+    # Same test as \w
+    if prev.isalnum() or prev == "_":
+        return ""
+    return match.group()
+
+def _drop_single_letter(match):
+    # strip off *all* leading/trailing punctuation
+    # (str.strip() with the full table, so we catch Unicode too)
+    core = match.group()[1:].strip(punct_string())
+    if len(core) == 1 and core.isalpha():
+        return ""
+    return match.group()
 
 # ----------------------------------------------------------------
 # Remove single letter words but keep hyphenated letters
@@ -26,25 +116,12 @@ def remove_single_letter_tokens(text: str) -> str:
     """
     Splits on whitespace, strips any leading/trailing punctuation
     (including Unicode punctuation) from each token, and drops it
-    if what's left is exactly one ASCII letter.
+    if what's left is exactly one letter.
     """
-    out = []
-    for tok in text.split():
-        # strip off *all* leading/trailing punctuation
-        # (we do this manually rather than str.strip() so we catch Unicode too)
-        start, end = 0, len(tok)
-        while start < end and tok[start] in _PUNCT_CHARS:
-            start += 1
-        while end > start and tok[end-1] in _PUNCT_CHARS:
-            end -= 1
-        core = tok[start:end]
-
-        # if the core is exactly one ASCII letter, drop it
-        if len(core) == 1 and core.isalpha():
-            continue
-
-        out.append(tok)
-    return " ".join(out)
+    # Only the rare candidate tokens reach Python code: the regex
+    # scan skips over everything else, and split/join then tidies
+    # up the whitespace left behind
+    return " ".join(_SINGLE_CHAR_TOKEN_RE.sub(_drop_single_letter, f" {text} ").split())
 
 # ----------------------------------------------------------------
 # Handle possessives properly
@@ -53,39 +130,312 @@ def clean_pdf_text(text: str) -> str:
     # Normalise apostrophes
     text = text.replace("’", "'")
     # Strip simple possessives: word’s --> word
-    text = re.sub(r"\b(\w+)'s\b", r"\1", text, flags=re.IGNORECASE)
-    return text
+    if _STACKED_POSSESSIVE_RE.search(text):
+        return _POSSESSIVE_RE.sub(r"\1", text)
+    return _APOSTROPHE_S_RE.sub(_drop_possessive, text)
+
+# ----------------------------------------------------------------
+# Normalise the raw text of a single page into the paragraph that
+# split_into_chunks() would have produced from it.
+# Regex work is confined to two scans that stop only at "'s" and
+# at tokens of one word character; the remaining steps (hyphenated
+# line breaks, hard newlines, whitespace and edge punctuation) are
+# plain str methods. The possessives have to go first and the
+# single letters last, as in the original passes, since joining
+# hyphenated lines changes both.
+# Returns None for pages with no text.
+# (Pages never contain a paragraph break once their newlines are
+# flattened, so each page is exactly one paragraph.)
+# ----------------------------------------------------------------
+def normalise_page(text):
+    text = clean_pdf_text(text)
+    text = text.replace("-\n", "").replace("\n", " ").strip()
+    if not text:
+        return None
+    return remove_single_letter_tokens(text.strip(EDGE_CHARS))
+
+# ----------------------------------------------------------------
+# Indices of the first and last few non-blank lines of a page,
+# where running headers and footers sit
+# ----------------------------------------------------------------
+def _edge_line_indices(lines):
+    nonblank = [i for i, line in enumerate(lines) if line.strip()]
+    return set(nonblank[:BOILERPLATE_EDGE_LINES] + nonblank[-BOILERPLATE_EDGE_LINES:])
+
+# ----------------------------------------------------------------
+# Key used to match header/footer lines across pages
+# (case-insensitive, with page numbers collapsed)
+# ----------------------------------------------------------------
+def _boilerplate_key(line):
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+# ----------------------------------------------------------------
+# Find the header/footer lines that repeat across the raw pages
+# of one document
+# ----------------------------------------------------------------
+def find_page_boilerplate(raw_pages):
+    counts = Counter()
+    for text in raw_pages:
+        lines = text.split("\n")
+        counts.update({_boilerplate_key(lines[i]) for i in _edge_line_indices(lines)})
+    min_pages = max(3, BOILERPLATE_MIN_FRACTION * len(raw_pages))
+    return {key for key, n in counts.items() if n >= min_pages}
+
+# ----------------------------------------------------------------
+# Remove header/footer lines found by find_page_boilerplate from
+# the top and bottom of a raw page
+# ----------------------------------------------------------------
+def strip_page_boilerplate(text, boilerplate):
+    lines = text.split("\n")
+    drop = {i for i in _edge_line_indices(lines) if _boilerplate_key(lines[i]) in boilerplate}
+    if not drop:
+        return text
+    return "\n".join(line for i, line in enumerate(lines) if i not in drop)
+
+# ----------------------------------------------------------------
+# Normalise the raw pages of one document, stripping repeated
+# headers and footers first if requested
+# ----------------------------------------------------------------
+def normalise_document(raw_pages, strip_boilerplate=False):
+    if strip_boilerplate:
+        boilerplate = find_page_boilerplate(raw_pages)
+        raw_pages = (strip_page_boilerplate(text, boilerplate) for text in raw_pages)
+    return [normalise_page(text) for text in raw_pages]
+
+# ----------------------------------------------------------------
+# Extract normalised text from pages [start, stop) of a single PDF.
+# Runs in a worker process in parallel mode, so it opens (and
+# closes) its own handle on the document.
+# raw = return the page text as extracted, e.g. when headers and
+# footers need detecting across the whole document first
+# ----------------------------------------------------------------
+def extract_page_range(path, start, stop, raw=False):
+    with fitz.open(path) as doc:
+        texts = [doc[i].get_text() for i in range(start, stop)]
+    return texts if raw else [normalise_page(text) for text in texts]
+
+# ----------------------------------------------------------------
+# Count the pages in a PDF without extracting any text
+# ----------------------------------------------------------------
+def count_pages(path):
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+# ----------------------------------------------------------------
+# Chunk the normalised pages of one file.
+# Pages can be any iterable (e.g. a generator over an open
+# document), and are consumed one at a time.
+# With max_tokens set, chunks are budgeted in tokens of the
+# embedding model instead of characters (see iter_token_chunks).
+# ----------------------------------------------------------------
+def chunk_pages(pages, year, max_tokens=None, overlap_tokens=0):
+    with trace_stage("chunking") as stage:
+        # Each non-empty page is one paragraph
+        paragraphs = (text for text in pages if text is not None)
+        if max_tokens:
+            chunks = iter_token_chunks(paragraphs, load_token_counter(EMBEDDING_MODEL),
+                                       max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+        else:
+            chunks = iter_paragraph_chunks(paragraphs, max_length=1000)
+        chunks = [{"year": year, "text": chunk} for chunk in chunks]
+        stage.set(items=len(chunks))
+    return chunks
+
+# ----------------------------------------------------------------
+# Normalised pages of an open PDF: a generator, so pages are
+# parsed as the chunker consumes them (traced as "pdf_parse"),
+# unless headers and footers need finding across the whole
+# document first
+# ----------------------------------------------------------------
+def parse_pages(doc, fname, strip_boilerplate=False):
+    if strip_boilerplate:
+        with trace_stage("pdf_parse", items=doc.page_count, file=fname):
+            return normalise_document([page.get_text() for page in doc], strip_boilerplate)
+    return trace_iter("pdf_parse", (normalise_page(page.get_text()) for page in doc), file=fname)
+
+# ----------------------------------------------------------------
+# List the PDF files in the given directory, in directory order
+# ----------------------------------------------------------------
+def list_pdfs(pdf_dir):
+    return [fname for fname in os.listdir(pdf_dir) if fname.endswith(".pdf")]
+
+# ----------------------------------------------------------------
+# Extract and chunk the given PDF files from pdf_dir.
+# Returns a dict of filename -> list of chunks.
+# With workers > 1, page ranges from all files are spread over a
+# process pool. Results are reassembled in file and page order, so
+# the output is identical to the single-process run.
+# ----------------------------------------------------------------
+def extract_files(pdf_dir, fnames, workers=1, max_tokens=None, overlap_tokens=0, strip_boilerplate=False):
+    chunks_by_file = {}
+    n_pages = 0
+    start_time = time.perf_counter()
+
+    if workers <= 1:
+        for fname in fnames:
+            path = os.path.join(pdf_dir, fname)
+            with fitz.open(path) as doc:
+                pages = parse_pages(doc, fname, strip_boilerplate)
+                chunks_by_file[fname] = chunk_pages(pages, extract_year(fname), max_tokens, overlap_tokens)
+                n_pages += doc.page_count
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Submit every page range up front, keeping the futures
+            # grouped by file so they can be collected in order
+            jobs = []
+            for fname in fnames:
+                path = os.path.join(pdf_dir, fname)
+                total = count_pages(path)
+                futures = [pool.submit(extract_page_range, path, start, min(start + PAGES_PER_TASK, total),
+                                       raw=strip_boilerplate)
+                           for start in range(0, total, PAGES_PER_TASK)]
+                jobs.append((fname, futures))
+
+            for fname, futures in jobs:
+                # (time waiting for the workers' pages)
+                with trace_stage("pdf_parse", file=fname) as stage:
+                    pages = []
+                    for future in futures:
+                        pages.extend(future.result())
+                    if strip_boilerplate:
+                        pages = normalise_document(pages, strip_boilerplate)
+                    stage.set(items=len(pages))
+                n_pages += len(pages)
+                chunks_by_file[fname] = chunk_pages(pages, extract_year(fname), max_tokens, overlap_tokens)
+
+    elapsed = time.perf_counter() - start_time
+    rate = n_pages / elapsed if elapsed > 0 else float("inf")
+    print(f"Extracted {n_pages} pages from {len(fnames)} files in {elapsed:.1f}s "
+          f"({rate:.1f} pages/s, workers={workers})")
+
+    return chunks_by_file
 
 # ----------------------------------------------------------------
 # Extract and process text from all PDFs in the given directory
 # ----------------------------------------------------------------
-def extract_text_from_pdfs(pdf_dir):
-    chunks = []
+def extract_text_from_pdfs(pdf_dir, workers=1, max_tokens=None, overlap_tokens=0, strip_boilerplate=False):
+    fnames = list_pdfs(pdf_dir)
+    chunks_by_file = extract_files(pdf_dir, fnames, workers=workers, max_tokens=max_tokens,
+                                   overlap_tokens=overlap_tokens, strip_boilerplate=strip_boilerplate)
 
-    for fname in os.listdir(pdf_dir):
-        if not fname.endswith(".pdf"):
-            continue
+    chunks = []
+    for fname in fnames:
+        chunks.extend(chunks_by_file[fname])
+    return chunks
 
-        year = extract_year(fname)
+# ----------------------------------------------------------------
+# Generator version of extract_text_from_pdfs: yields chunks one
+# file at a time, so only a single report is held in memory.
+# Used by the streaming ingest in utils/assistant_helpers.py
+# ----------------------------------------------------------------
+def iter_chunks(pdf_dir, max_tokens=None, overlap_tokens=0, strip_boilerplate=False):
+    for fname in list_pdfs(pdf_dir):
         path = os.path.join(pdf_dir, fname)
-        doc = fitz.open(path)
-        full_text = ""
-
-        for page in doc:
-            # Clean and flatten text from each page
-            text = page.get_text()
-            text = clean_pdf_text(text)
-            text = text.replace("-\n", "")  # Fix hyphenated line breaks
-            text = text.replace("\n", " ")  # Replace hard newlines with space
-            full_text += text + "\n\n"      # Simulate paragraph spacing between pages
-
-        # Chunk the cleaned text
-        split_chunks = split_into_chunks(full_text, max_length=1000)
-        for chunk in split_chunks:
-            chunks.append({"year": year, "text": chunk})
+        with fitz.open(path) as doc:
+            pages = parse_pages(doc, fname, strip_boilerplate)
+            chunks = chunk_pages(pages, extract_year(fname), max_tokens, overlap_tokens)
+        yield from chunks
+
+# ----------------------------------------------------------------
+# SHA-256 of a file's contents, read in blocks
+# ----------------------------------------------------------------
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+# ----------------------------------------------------------------
+# Incrementally update chunks.json using a manifest that records,
+# for each source PDF, its content hash and the [start, end) range
+# of its chunks in chunks.json, along with the chunking settings.
+# Unchanged files keep their existing chunks, new or modified files
+# are re-extracted, and files no longer in pdf_dir are dropped.
+# Changing the chunking settings, or a chunks.json that doesn't
+# match the hash recorded in the manifest, forces a full rebuild.
+# The result is the same as a full rebuild.
+# ----------------------------------------------------------------
+def update_chunks(pdf_dir, output_path, manifest_path, workers=1, full_rebuild=False,
+                  max_tokens=None, overlap_tokens=0, strip_boilerplate=False):
+
+    settings = {"max_tokens": max_tokens, "overlap_tokens": overlap_tokens if max_tokens else 0}
+    if strip_boilerplate:
+        settings["strip_boilerplate"] = True
+    if max_tokens:
+        settings["model"] = EMBEDDING_MODEL
+
+    old_chunks, old_manifest = [], {}
+    if not full_rebuild and os.path.exists(output_path) and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            saved = json.load(f)
+        if saved.get("settings") != settings:
+            print("Chunking settings changed: re-extracting all files")
+        elif saved.get("chunks_sha256") != file_hash(output_path):
+            # (chunks.json was written by another run or tool since,
+            # so the manifest's chunk ranges can't be trusted)
+            print(f"{os.path.basename(output_path)} does not match the manifest: re-extracting all files")
+        else:
+            with open(output_path, "r") as f:
+                old_chunks = json.load(f)
+            old_manifest = saved["files"]
+
+    fnames = list_pdfs(pdf_dir)
+    with trace_stage("hash_pdfs", items=len(fnames)):
+        hashes = {fname: file_hash(os.path.join(pdf_dir, fname)) for fname in fnames}
+
+    unchanged = [fname for fname in fnames
+                 if fname in old_manifest and old_manifest[fname]["sha256"] == hashes[fname]]
+    to_extract = [fname for fname in fnames if fname not in unchanged]
+    removed = [fname for fname in old_manifest if fname not in hashes]
+
+    print(f"{len(unchanged)} unchanged, {len(to_extract)} new or modified, {len(removed)} removed")
+
+    chunks_by_file = {fname: old_chunks[old_manifest[fname]["start"]:old_manifest[fname]["end"]]
+                      for fname in unchanged}
+    if to_extract:
+        chunks_by_file.update(extract_files(pdf_dir, to_extract, workers=workers, max_tokens=max_tokens,
+                                            overlap_tokens=overlap_tokens, strip_boilerplate=strip_boilerplate))
+
+    # Reassemble in directory order and record the new chunk ranges
+    chunks, manifest = [], {}
+    for fname in fnames:
+        start = len(chunks)
+        chunks.extend(chunks_by_file[fname])
+        manifest[fname] = {"sha256": hashes[fname], "start": start, "end": len(chunks)}
+
+    # Nothing to write if no file changed
+    if not to_extract and not removed:
+        return chunks
+
+    # Each file is replaced atomically, and the manifest records
+    # the hash of the chunks.json it describes, so if the run
+    # stops between the two, the next one starts afresh
+    with trace_stage("write_chunks", items=len(chunks)):
+        data = json.dumps(chunks, indent=2).encode("utf-8")
+        write_file_atomic(output_path, data)
+        manifest = {"settings": settings, "chunks_sha256": hashlib.sha256(data).hexdigest(), "files": manifest}
+        write_file_atomic(manifest_path, json.dumps(manifest, indent=2).encode("utf-8"))
 
     return chunks
 
+# ----------------------------------------------------------------
+# Write bytes to a file through a temporary file and os.replace,
+# so readers never see a partly written file
+# ----------------------------------------------------------------
+def write_file_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 # ----------------------------------------------------------------
 # Extracts the first 4-digit number from the filename as the year
 # ----------------------------------------------------------------
@@ -104,56 +454,191 @@ def split_into_chunks(text, max_length=1000):
     # Split text into paragraphs (based on double newlines)
     paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
 
-    chunks = []
-    current_chunk = ""
+    # Remove any leading or trailing characters from each paragraph
+    # string, then remove single letter words
+    paragraphs = [remove_single_letter_tokens(para.strip(EDGE_CHARS)) for para in paragraphs]
 
-    for para in paragraphs:
+    return chunk_paragraphs(paragraphs, max_length=max_length)
 
-        # Remove any leading or trailing characters from the paragraph string
-        para = para.strip(" ,.-–—‘“”\"")
+# ----------------------------------------------------------------
+# Accumulates already-normalised paragraphs into chunks of
+# approximately max_length characters, splitting long paragraphs
+# on sentence boundaries
+# ----------------------------------------------------------------
+def chunk_paragraphs(paragraphs, max_length=1000):
+    return list(iter_paragraph_chunks(paragraphs, max_length=max_length))
 
-        # Remove single letter words
-        para = remove_single_letter_tokens(para)
+# ----------------------------------------------------------------
+# Streaming version of chunk_paragraphs: consumes paragraphs one at
+# a time and yields chunks as soon as they are complete.
+# Parts are collected in lists and joined once per chunk, keeping
+# running lengths, so the work is linear in the length of the text.
+# ----------------------------------------------------------------
+def iter_paragraph_chunks(paragraphs, max_length=1000):
+
+    # current_chunk is "".join(p + "\n\n" for p in current_parts)
+    current_parts = []
+    current_length = 0
+
+    for para in paragraphs:
 
         # Accumulate paragraphs until close to max_length
-        if len(current_chunk) + len(para) + 2 < max_length:
-            current_chunk += para + "\n\n"
+        if current_length + len(para) + 2 < max_length:
+            current_parts.append(para)
+            current_length += len(para) + 2
         else:
-            if current_chunk.strip():
-                chunks.append(current_chunk.strip())
+            current_chunk = "\n\n".join(current_parts).strip()
+            if current_chunk:
+                yield current_chunk
             if len(para) >= max_length:
                 # Split long paragraphs on sentence boundaries
                 sentences = re.split(r'(?<=[.!?])\s+', para)
-                buffer = ""
+                buffer_parts = []
+                buffer_length = 0
                 for sentence in sentences:
-                    if len(buffer) + len(sentence) + 1 < max_length:
-                        buffer += sentence + " "
+                    if buffer_length + len(sentence) + 1 < max_length:
+                        buffer_parts.append(sentence)
+                        buffer_length += len(sentence) + 1
                     else:
-                        chunks.append(buffer.strip())
-                        buffer = sentence + " "
-                if buffer.strip():
-                    chunks.append(buffer.strip())
-                current_chunk = ""
+                        yield " ".join(buffer_parts).strip()
+                        buffer_parts = [sentence]
+                        buffer_length = len(sentence) + 1
+                buffer = " ".join(buffer_parts).strip()
+                if buffer:
+                    yield buffer
+                current_parts = []
+                current_length = 0
             else:
-                current_chunk = para + "\n\n"
+                current_parts = [para]
+                current_length = len(para) + 2
 
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
+    current_chunk = "\n\n".join(current_parts).strip()
+    if current_chunk:
+        yield current_chunk
 
-    return chunks
+# ----------------------------------------------------------------
+# Load a function that counts tokens as the embedding model sees
+# them (word pieces, without the special tokens the model adds)
+# ----------------------------------------------------------------
+@lru_cache(maxsize=None)
+def load_token_counter(model_name):
+    from transformers import AutoTokenizer
+
+    # SentenceTransformer accepts short names for its own models
+    repo_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(repo_id)
+
+    def count_tokens(text):
+        return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    return count_tokens
+
+# ----------------------------------------------------------------
+# Break paragraphs into units of at most max_tokens tokens:
+# whole paragraphs where they fit, otherwise sentences, and
+# word windows for sentences that are still too long.
+# Yields (text, n_tokens, starts_paragraph) tuples.
+# ----------------------------------------------------------------
+def _iter_token_units(paragraphs, count_tokens, max_tokens):
+    for para in paragraphs:
+        n_tokens = count_tokens(para)
+        if n_tokens <= max_tokens:
+            yield para, n_tokens, True
+            continue
+
+        starts_paragraph = True
+        for sentence in re.split(r'(?<=[.!?])\s+', para):
+            n_tokens = count_tokens(sentence)
+            if n_tokens <= max_tokens:
+                yield sentence, n_tokens, starts_paragraph
+                starts_paragraph = False
+                continue
+
+            words, words_tokens = [], 0
+            for word in sentence.split():
+                word_tokens = count_tokens(word)
+                if words and words_tokens + word_tokens > max_tokens:
+                    yield " ".join(words), words_tokens, starts_paragraph
+                    starts_paragraph = False
+                    words, words_tokens = [], 0
+                words.append(word)
+                words_tokens += word_tokens
+            if words:
+                yield " ".join(words), words_tokens, starts_paragraph
+                starts_paragraph = False
+
+# ----------------------------------------------------------------
+# Join units back into chunk text, keeping paragraph breaks
+# ----------------------------------------------------------------
+def _join_token_units(units):
+    parts = []
+    for text, _, starts_paragraph in units:
+        if parts:
+            parts.append("\n\n" if starts_paragraph else " ")
+        parts.append(text)
+    return "".join(parts).strip()
+
+# ----------------------------------------------------------------
+# Streaming, token-budgeted chunker: packs paragraphs (or their
+# sentences, if too long) into chunks of at most max_tokens tokens
+# of the embedding model, so nothing is silently truncated by
+# SentenceTransformer.encode. With overlap_tokens > 0, each chunk
+# starts with the trailing units of the previous one, up to that
+# many tokens. Each unit is tokenised once, so the work is linear.
+# ----------------------------------------------------------------
+def iter_token_chunks(paragraphs, count_tokens, max_tokens, overlap_tokens=0):
+    window = deque()
+    window_tokens = 0
+
+    for unit in _iter_token_units(paragraphs, count_tokens, max_tokens):
+        n_tokens = unit[1]
+
+        if window and window_tokens + n_tokens > max_tokens:
+            yield _join_token_units(window)
+
+            # Carry over the tail of the chunk as overlap
+            tail, tail_tokens = deque(), 0
+            for prev in reversed(window):
+                if tail_tokens + prev[1] > overlap_tokens:
+                    break
+                tail.appendleft(prev)
+                tail_tokens += prev[1]
+            window, window_tokens = tail, tail_tokens
+
+            # Drop overlap if there's no room for the new unit
+            while window and window_tokens + n_tokens > max_tokens:
+                window_tokens -= window.popleft()[1]
+
+        window.append(unit)
+        window_tokens += n_tokens
+
+    if window:
+        yield _join_token_units(window)
 
 
 # ------------------------------------------------------------
 # Main
 # ------------------------------------------------------------
 if __name__ == "__main__":
-    ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Extract and chunk text from the annual review PDFs")
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes for PDF parsing (default: 1)')
+    parser.add_argument('--full', action='store_true', help='Ignore the manifest and re-extract every PDF')
+    parser.add_argument('--strip-boilerplate', action='store_true', help='Strip running headers and footers that repeat across the pages of a report')
+    parser.add_argument('--tokens', action='store_true', help=f'Budget chunks in tokens of the embedding model (max {CHUNK_MAX_TOKENS}) instead of characters')
+    parser.add_argument('--overlap', type=int, default=CHUNK_OVERLAP_TOKENS, help='Tokens of overlap between adjacent chunks (with --tokens)')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const=PROFILE_TRACE_FILE, default=None, help='Write a JSONL trace of each stage to FILE and print p50/p95/p99 timings')
+    args = parser.parse_args()
+
+    if args.profile:
+        start_trace(args.profile)
+
     input_dir = os.path.join(ROOT, "data", "annual_reviews")
     output_path = os.path.join(ROOT, "data", "chunks.json")
+    manifest_path = os.path.join(ROOT, "data", "chunks_manifest.json")
 
-    # Extract and chunk the text
-    chunks = extract_text_from_pdfs(input_dir)
-
-    # Write to JSON file
-    with open(output_path, "w") as f:
-        json.dump(chunks, f, indent=2)
+    # Extract and chunk new or modified PDFs, and write to JSON file
+    update_chunks(input_dir, output_path, manifest_path, workers=args.workers, full_rebuild=args.full,
+                  max_tokens=CHUNK_MAX_TOKENS if args.tokens else None, overlap_tokens=args.overlap,
+                  strip_boilerplate=args.strip_boilerplate)
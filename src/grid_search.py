@@ -0,0 +1,298 @@
+# ================================================================
+# Staged, parallel and resumable grid search over UMAP and HDBSCAN
+# hyperparameters for the BERTopic clustering model (the scans in
+# notebooks/grid_search_clustering_analysis.ipynb).
+#
+# Rather than a full BERTopic fit per grid point:
+#  1. Embeddings are computed once (via the shared embedding store)
+#  2. Each UMAP reduction is computed once per (n_neighbors,
+#     min_dist) and cached on disk
+#  3. HDBSCAN is run on the cached reductions for every
+#     min_cluster_size
+# Both stages run in a process pool. Each result is appended to a
+# JSONL file as soon as it is ready, and finished grid points are
+# skipped on a rerun, so an interrupted sweep picks up where it
+# left off.
+#
+# Usage:
+#    python src/grid_search.py --scan coarse|fine [--workers N] [--save-models]
+# ================================================================
+
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import itertools
+import datetime
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from assistant_config import BASE_DIR, CHUNKS_FILE, EMBEDDING_MODEL
+
+OUTPUT_DIR = os.path.join(BASE_DIR, "models", "hp_optimisation")
+
+# ----------------------------------------------------------------
+# Grids (as in the notebook)
+# ----------------------------------------------------------------
+SCANS = {
+    # Initial coarse scan over n_neighbors and min_cluster_size
+    "coarse": {
+        "n_neighbors": [5, 10, 15],
+        "min_dist": [0.0],
+        "min_cluster_size": [10, 15, 20, 25, 30],
+    },
+    # Fine-tuned scan around promising min_cluster_size values,
+    # exploring min_dist settings
+    "fine": {
+        "n_neighbors": [10],
+        "min_dist": [0.0, 0.1, 0.2],
+        "min_cluster_size": [25, 28, 30],
+    },
+}
+
+# Fixed settings
+N_COMPONENTS = 5
+MIN_SAMPLES = 5
+RANDOM_STATE = 42
+
+# ----------------------------------------------------------------
+# Load texts and embeddings the same way as the notebooks
+# ----------------------------------------------------------------
+def load_texts_and_embeddings():
+    from sentence_transformers import SentenceTransformer
+    from utils.dedup_helpers import deduplicate_chunks
+    from utils.embedding_store import get_embeddings
+
+    with open(CHUNKS_FILE, "r") as f:
+        data = json.load(f)
+    data, _ = deduplicate_chunks(data)
+    texts = [entry["text"] for entry in data]
+
+    embeddings = get_embeddings(SentenceTransformer(EMBEDDING_MODEL), texts)
+    return texts, embeddings
+
+# ----------------------------------------------------------------
+# Path of the cached UMAP reduction for one (n_neighbors, min_dist).
+# The cache is keyed on the embeddings too, so it is never reused
+# for different data.
+# ----------------------------------------------------------------
+def umap_cache_path(cache_dir, n_neighbors, min_dist):
+    return os.path.join(cache_dir, f"umap_neighbors{n_neighbors}_dist{min_dist}.npy")
+
+# The fitted UMAP model behind a cached reduction (kept for
+# --save-models, so saved models can transform new documents)
+def umap_model_path(cache_file):
+    return os.path.splitext(cache_file)[0] + ".pkl"
+
+# ----------------------------------------------------------------
+# Stage 1: UMAP reduction, fitted and transformed as BERTopic does
+# keep_model = also save the fitted UMAP model
+# ----------------------------------------------------------------
+def run_umap(embeddings_file, cache_file, n_neighbors, min_dist, keep_model=False):
+    from umap import UMAP
+
+    model_file = umap_model_path(cache_file)
+    if os.path.exists(cache_file) and (not keep_model or os.path.exists(model_file)):
+        return cache_file
+
+    embeddings = np.load(embeddings_file, mmap_mode="r")
+    umap_model = UMAP(
+        n_neighbors=n_neighbors,
+        n_components=N_COMPONENTS,
+        min_dist=min_dist,
+        metric="cosine",
+        random_state=RANDOM_STATE
+    )
+    umap_model.fit(embeddings)
+    reduced = np.nan_to_num(umap_model.transform(embeddings))
+
+    # Write then rename, so a killed worker never leaves a partial file
+    if keep_model:
+        tmp_file = model_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(umap_model, f)
+        os.replace(tmp_file, model_file)
+    tmp_file = cache_file + ".tmp.npy"
+    np.save(tmp_file, reduced)
+    os.replace(tmp_file, cache_file)
+    return cache_file
+
+# ----------------------------------------------------------------
+# Stage 2: HDBSCAN on a cached reduction
+# ----------------------------------------------------------------
+def run_hdbscan(cache_file, min_cluster_size):
+    import hdbscan
+
+    reduced = np.load(cache_file)
+    hdbscan_model = hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        min_samples=MIN_SAMPLES,
+        metric="euclidean",
+        cluster_selection_method="eom"
+    )
+    # (prediction_data isn't needed here: it doesn't change the labels)
+    labels = hdbscan_model.fit(reduced).labels_
+    return {
+        "n_topics": int(len(set(labels) - {-1})),
+        "noise_fraction": float(np.mean(labels == -1)),
+    }
+
+# ----------------------------------------------------------------
+# Stand-in for UMAP while BERTopic is fitted on a grid point:
+# fitting does nothing, and transforming the documents returns
+# the cached reduction of their embeddings
+# ----------------------------------------------------------------
+class CachedReduction:
+
+    def __init__(self, reduced):
+        self.reduced = reduced
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return self.reduced
+
+# ----------------------------------------------------------------
+# Fit and save a full BERTopic model for one grid point, on the
+# document embeddings but reusing the cached UMAP reduction of
+# them. The fitted UMAP model then replaces the stand-in before
+# saving, so the saved model (with its embedding model) embeds,
+# reduces and transforms new documents like one fitted end to end.
+# ----------------------------------------------------------------
+def save_model(texts, embeddings, cache_file, params, model_dir):
+    import hdbscan
+    from bertopic import BERTopic
+    from sklearn.feature_extraction.text import CountVectorizer
+    from utils.stopwords import CUSTOM_STOPWORDS, TOKEN_PATTERN
+
+    topic_model = BERTopic(
+        embedding_model=EMBEDDING_MODEL,
+        vectorizer_model=CountVectorizer(stop_words=CUSTOM_STOPWORDS, ngram_range=(1, 2), token_pattern=TOKEN_PATTERN),
+        umap_model=CachedReduction(np.load(cache_file)),
+        hdbscan_model=hdbscan.HDBSCAN(
+            min_cluster_size=params["min_cluster_size"],
+            min_samples=MIN_SAMPLES,
+            metric="euclidean",
+            cluster_selection_method="eom",
+            prediction_data=True
+        ),
+        calculate_probabilities=True
+    )
+    topic_model.fit_transform(texts, embeddings=embeddings)
+    with open(umap_model_path(cache_file), "rb") as f:
+        topic_model.umap_model = pickle.load(f)
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d")
+    model_name = (f"bertopic_neighbors{params['n_neighbors']}_cluster{params['min_cluster_size']}"
+                  f"_dist{params['min_dist']}_{timestamp}")
+    topic_model.save(os.path.join(model_dir, model_name))
+    return model_name
+
+# ----------------------------------------------------------------
+# Read results already written by a previous (possibly
+# interrupted) run. A grid point rerun to save its model has a
+# later line of its own, which replaces the earlier one.
+# ----------------------------------------------------------------
+def load_results(results_file):
+    results = {}
+    if os.path.exists(results_file):
+        with open(results_file, "r") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue  # partly written last line
+                results[(r.get("data"), r["n_neighbors"], r["min_dist"], r["min_cluster_size"])] = r
+    return list(results.values())
+
+# ----------------------------------------------------------------
+# Run a scan, appending results to results_file as they finish
+# and skipping grid points that are already done
+# ----------------------------------------------------------------
+def run_grid_search(scan, workers=None, save_models=False, output_dir=OUTPUT_DIR):
+    grid = SCANS[scan]
+    os.makedirs(output_dir, exist_ok=True)
+    results_file = os.path.join(output_dir, f"grid_search_{scan}.jsonl")
+
+    texts, embeddings = load_texts_and_embeddings()
+
+    # Share the embeddings with the workers through a file rather
+    # than pickling them for every task
+    digest = hashlib.sha1(np.ascontiguousarray(embeddings).tobytes()).hexdigest()[:12]
+    cache_dir = os.path.join(output_dir, "umap_cache", digest)
+    os.makedirs(cache_dir, exist_ok=True)
+    embeddings_file = os.path.join(cache_dir, "embeddings.npy")
+    if not os.path.exists(embeddings_file):
+        np.save(embeddings_file, embeddings)
+
+    # (with --save-models, grid points done without saving a model
+    # are run again, so that every point gets one)
+    done = {(r["n_neighbors"], r["min_dist"], r["min_cluster_size"])
+            for r in load_results(results_file)
+            if r.get("data") == digest and (not save_models or r.get("model_name"))}
+    todo = [p for p in itertools.product(grid["n_neighbors"], grid["min_dist"], grid["min_cluster_size"])
+            if p not in done]
+    print(f"{scan} scan: {len(done)} grid points already done, {len(todo)} to run")
+    if not todo:
+        return [r for r in load_results(results_file) if r.get("data") == digest]
+
+    reductions = sorted({(n_neighbors, min_dist) for n_neighbors, min_dist, _ in todo})
+
+    # Terminate any partly written last line before appending
+    if os.path.exists(results_file) and os.path.getsize(results_file) > 0:
+        with open(results_file, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(results_file, "a") as out:
+
+        # Stage 1: one UMAP per (n_neighbors, min_dist)
+        umap_futures = {
+            pool.submit(run_umap, embeddings_file, umap_cache_path(cache_dir, *key), *key, save_models): key
+            for key in reductions
+        }
+
+        # Stage 2: as each reduction is ready, queue its HDBSCAN runs
+        hdbscan_futures = {}
+        for future in as_completed(umap_futures):
+            n_neighbors, min_dist = umap_futures[future]
+            cache_file = future.result()
+            print(f"UMAP ready: n_neighbors={n_neighbors}, min_dist={min_dist}")
+            for p in todo:
+                if p[:2] == (n_neighbors, min_dist):
+                    hdbscan_futures[pool.submit(run_hdbscan, cache_file, p[2])] = (p, cache_file)
+
+        for future in as_completed(hdbscan_futures):
+            (n_neighbors, min_dist, min_cluster_size), cache_file = hdbscan_futures[future]
+            result = {
+                "n_neighbors": n_neighbors,
+                "min_dist": min_dist,
+                "min_cluster_size": min_cluster_size,
+                **future.result(),
+                "data": digest,
+            }
+            if save_models:
+                result["model_name"] = save_model(texts, embeddings, cache_file, result, output_dir)
+
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            print(f"n_neighbors={n_neighbors}, min_dist={min_dist}, "
+                  f"min_cluster_size={min_cluster_size}: {result['n_topics']} topics")
+
+    return [r for r in load_results(results_file) if r.get("data") == digest]
+
+
+# ------------------------------------------------------------
+# Main
+# ------------------------------------------------------------
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Grid search over UMAP/HDBSCAN hyperparameters")
+    parser.add_argument('--scan', choices=sorted(SCANS), default="coarse", help='Which grid to run (default: coarse)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--save-models', action='store_true', help='Also fit and save a BERTopic model for each grid point')
+    args = parser.parse_args()
+
+    run_grid_search(args.scan, workers=args.workers, save_models=args.save_models)
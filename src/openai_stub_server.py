@@ -0,0 +1,108 @@
+# ================================================================
+# Minimal local OpenAI-compatible server for trying out the RAG
+# path (streaming, concurrency, timeouts and retries) without an
+# API key or credit.
+# Answers POST /v1/chat/completions, streamed or not, with a canned
+# answer echoing the question, one word per token.
+#
+# Usage:
+#    python src/openai_stub_server.py [--port 8000] [--token-delay 0.05]
+#                                     [--fail-rate 0.2] [--hang-rate 0.1]
+#                                     [--drop-rate 0.1]
+# then, in another terminal:
+#    OPENAI_BASE_URL=http://localhost:8000/v1 OPENAI_API_KEY=stub \
+#        python src/assistant.py
+# ================================================================
+
+import re
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ----------------------------------------------------------------
+# Canned answer: the question from the prompt, echoed back
+# ----------------------------------------------------------------
+def stub_answer(messages):
+    prompt = messages[-1]["content"] if messages else ""
+    match = re.search(r"Question:\s*(.*?)\s*Answer:", prompt, flags=re.DOTALL)
+    question = match.group(1) if match else prompt[:100]
+    return f"This is a stub answer to: {question}"
+
+def make_handler(token_delay, fail_rate, hang_rate, drop_rate=0.0):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+            # Simulated failures, to exercise retries and timeouts
+            if random.random() < fail_rate:
+                self.send_response(500)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps({"error": {"message": "Stub server error"}}).encode())
+                return
+            if random.random() < hang_rate:
+                time.sleep(3600)
+                return
+
+            answer = stub_answer(request.get("messages", []))
+            base = {"id": "stub", "created": int(time.time()), "model": request.get("model", "stub")}
+
+            if not request.get("stream"):
+                body = {**base, "object": "chat.completion",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": answer}}]}
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+                return
+
+            # A dropped stream promises more body than it sends, then
+            # closes the connection part way through the answer
+            drop = random.random() < drop_rate
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            if drop:
+                self.send_header("Content-Length", str(1 << 20))
+            self.end_headers()
+            words = answer.split(" ")
+            for i, word in enumerate(words):
+                if drop and i == len(words) // 2:
+                    self.close_connection = True
+                    return
+                time.sleep(token_delay)
+                chunk = {**base, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "finish_reason": None,
+                                      "delta": {"content": word + (" " if i < len(words) - 1 else "")}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server")
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--token-delay', type=float, default=0.05, help='Seconds between streamed tokens')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of requests answered with a 500 error')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='Fraction of requests that never answer')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Fraction of streamed answers cut off half way')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("localhost", args.port),
+                                 make_handler(args.token_delay, args.fail_rate, args.hang_rate, args.drop_rate))
+    print(f"Stub OpenAI server on http://localhost:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,187 @@
+# ==================================================================
+# Semantic answer cache for the assistant.
+# Answers are stored with the embedding of the question they
+# answered. A new question whose embedding has cosine similarity
+# of at least ANSWER_CACHE_SIMILARITY with a cached question (asked
+# in the same mode, with the same year filter) gets the cached
+# answer, skipping retrieval and generation.
+# Entries expire after ANSWER_CACHE_MAX_AGE_DAYS, the least recently
+# used are dropped beyond ANSWER_CACHE_MAX_ENTRIES, and the whole
+# cache is discarded when a new version of the index is built.
+# Changes (new answers, and the last-used time of answers reused)
+# are written to disk every ANSWER_CACHE_SAVE_EVERY changes or
+# ANSWER_CACHE_SAVE_SECONDS, and at exit, rather than rewriting the
+# whole cache after every answer.
+#
+# Layout: models/assistant/
+#    answer_cache.json : entries (question, answer, context, times)
+#    answer_cache.npy  : normalised question embeddings, one row each
+# ==================================================================
+
+import os
+import json
+import time
+import atexit
+import numpy as np
+from assistant_config import ANSWER_CACHE_FILE, ANSWER_CACHE_SIMILARITY
+from assistant_config import ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_AGE_DAYS
+from assistant_config import ANSWER_CACHE_SAVE_EVERY, ANSWER_CACHE_SAVE_SECONDS
+from utils.index_versions import current_version
+
+# --------------------------------------------------
+# Identifies the index the answers came from (each
+# build is a new version, never modified after)
+# --------------------------------------------------
+def index_fingerprint():
+    return current_version()
+
+# --------------------------------------------------
+# Key for the settings an answer depends on, so that
+# e.g. a RAG answer is never returned in retrieval
+# mode, or an answer for 2018 onwards for all years
+# --------------------------------------------------
+def cache_context(mode, min_year=None, max_year=None, exclude_years=None):
+    excluded = ",".join(str(y) for y in sorted(exclude_years or []))
+    return f"{mode}|{min_year}|{max_year}|{excluded}"
+
+# --------------------------------------------------
+# Empty cache for the current index
+# --------------------------------------------------
+def new_answer_cache(index_id=None):
+    return {"index": index_id, "entries": [], "embeddings": None, "unsaved": 0, "saved_at": time.time()}
+
+# --------------------------------------------------
+# Load the cache from disk, starting afresh if it
+# was built against a different index or is damaged.
+# Unsaved changes are written at exit.
+# --------------------------------------------------
+def load_answer_cache(cache_file=ANSWER_CACHE_FILE):
+    cache = _read_answer_cache(cache_file)
+    atexit.register(flush_answer_cache, cache, cache_file)
+    return cache
+
+def _read_answer_cache(cache_file):
+    index_id = index_fingerprint()
+    embeddings_file = os.path.splitext(cache_file)[0] + ".npy"
+    if not (os.path.exists(cache_file) and os.path.exists(embeddings_file)):
+        return new_answer_cache(index_id)
+
+    try:
+        with open(cache_file, "r") as f:
+            saved = json.load(f)
+        embeddings = np.load(embeddings_file)
+    except (ValueError, OSError) as e:
+        print(f"[Warning] Could not read answer cache, starting a new one: {e}")
+        return new_answer_cache(index_id)
+
+    if saved.get("index") != index_id:
+        print("FAISS index has changed: clearing the answer cache.")
+        return new_answer_cache(index_id)
+    if len(saved["entries"]) != len(embeddings):
+        return new_answer_cache(index_id)
+
+    cache = new_answer_cache(index_id)
+    cache["entries"], cache["embeddings"] = saved["entries"], embeddings
+    evict(cache)
+    return cache
+
+# --------------------------------------------------
+# Write the cache (embeddings first, so a crash
+# part way through leaves a mismatch that is
+# discarded on the next load)
+# --------------------------------------------------
+def save_answer_cache(cache, cache_file=ANSWER_CACHE_FILE):
+    embeddings_file = os.path.splitext(cache_file)[0] + ".npy"
+    if cache["embeddings"] is None:
+        for path in (cache_file, embeddings_file):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    np.save(embeddings_file, cache["embeddings"])
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"index": cache["index"], "entries": cache["entries"]}, f)
+    os.replace(tmp_file, cache_file)
+    cache["unsaved"], cache["saved_at"] = 0, time.time()
+
+# --------------------------------------------------
+# Record a change to the cache, and write it if
+# enough changes or time have built up since the
+# last write
+# --------------------------------------------------
+def _changed(cache, save=True, cache_file=ANSWER_CACHE_FILE):
+    cache["unsaved"] += 1
+    if save and (cache["unsaved"] >= ANSWER_CACHE_SAVE_EVERY
+                 or time.time() - cache["saved_at"] >= ANSWER_CACHE_SAVE_SECONDS):
+        save_answer_cache(cache, cache_file)
+
+# --------------------------------------------------
+# Write any unsaved changes (unless the index has
+# been rebuilt since, which makes the cache stale)
+# --------------------------------------------------
+def flush_answer_cache(cache, cache_file=ANSWER_CACHE_FILE):
+    if cache["unsaved"] and cache["index"] == index_fingerprint():
+        save_answer_cache(cache, cache_file)
+
+# --------------------------------------------------
+# Drop expired entries, then the least recently
+# used ones beyond max_entries
+# --------------------------------------------------
+def evict(cache, max_entries=ANSWER_CACHE_MAX_ENTRIES, max_age_days=ANSWER_CACHE_MAX_AGE_DAYS):
+    entries = cache["entries"]
+    if not entries:
+        return
+
+    now = time.time()
+    keep = [i for i, entry in enumerate(entries) if now - entry["created"] <= max_age_days * 86400]
+    if len(keep) > max_entries:
+        keep = sorted(sorted(keep, key=lambda i: entries[i]["last_used"])[-max_entries:])
+
+    if len(keep) < len(entries):
+        cache["entries"] = [entries[i] for i in keep]
+        cache["embeddings"] = cache["embeddings"][keep] if keep else None
+
+# --------------------------------------------------
+# Unit-length copy of an embedding
+# --------------------------------------------------
+def _unit(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32).ravel()
+    return embedding / max(np.linalg.norm(embedding), 1e-12)
+
+# --------------------------------------------------
+# Cached answer for a question, or None.
+# Returns the entry for the most similar cached
+# question with the same context, if its cosine
+# similarity is at least min_similarity (and marks
+# it as used, which is saved with it for eviction).
+# --------------------------------------------------
+def lookup_answer(cache, query_embedding, context, min_similarity=ANSWER_CACHE_SIMILARITY):
+    if cache["embeddings"] is None:
+        return None
+
+    similarities = cache["embeddings"] @ _unit(query_embedding)
+    now = time.time()
+    for i in np.argsort(-similarities):
+        if similarities[i] < min_similarity:
+            break
+        entry = cache["entries"][i]
+        if entry["context"] == context and now - entry["created"] <= ANSWER_CACHE_MAX_AGE_DAYS * 86400:
+            entry["last_used"] = now
+            _changed(cache)
+            return entry
+    return None
+
+# --------------------------------------------------
+# Add an answer to the cache (save = write it to
+# disk when due, see _changed)
+# --------------------------------------------------
+def store_answer(cache, query, query_embedding, context, answer, save=True):
+    now = time.time()
+    cache["entries"].append({"query": query, "answer": answer, "context": context,
+                             "created": now, "last_used": now})
+    row = _unit(query_embedding)[None, :]
+    cache["embeddings"] = row if cache["embeddings"] is None else np.vstack([cache["embeddings"], row])
+    evict(cache)
+    _changed(cache, save)
@@ -6,71 +6,320 @@
 
 import os
 import json
+import shutil
+import queue
+import threading
 import faiss
 import numpy as np
+from collections import Counter
 from tqdm import tqdm
-from assistant_config import CHUNKS_FILE, INDEX_FILE, TEXTS_FILE
+from assistant_config import CHUNKS_FILE, PDF_DIR, INGEST_BATCH_SIZE, INGEST_PREFETCH, INGEST_PUBLISH_EVERY, DEDUP_CHUNKS
+from assistant_config import INDEX_TRAIN_SIZE, INDEX_FILE_NAME, LEXICAL_INDEX_NAME
+from utils.dedup_helpers import deduplicate_chunks, iter_unique_chunks, print_dedup_report
+from utils.embedding_store import embed_texts, get_embeddings
+from utils.index_helpers import new_index, build_faiss_index, configure_search, check_index_type, needs_training
+from utils.index_helpers import attach_lexical_index
+from utils.index_versions import current_version, version_dir, new_version, publish_version, migrate_unversioned_index
+from utils.index_versions import latest_complete_version, is_complete_version
+from utils.lexical_index import write_lexical_index, lexical_index_exists, open_lexical_index
+from utils.model_manager import get_index_embedding_model
+from utils.text_store import write_text_store, open_text_store, text_store_exists
+from utils.text_store import legacy_text_store_exists, convert_legacy_text_store
+from utils.tracing import trace_stage
 
 # --------------------------------------------------
 # Load data/chunks.json file
 # (produced by src/extract.py)
+# dedup = drop near-duplicate chunks
 # --------------------------------------------------
-def load_chunks(filepath):
-    with open(filepath, "r") as f:
-        chunks = json.load(f)
+def load_chunks(filepath, dedup=False):
+    with trace_stage("load_chunks") as stage:
+        with open(filepath, "r") as f:
+            chunks = json.load(f)
+        stage.set(items=len(chunks))
+    if dedup:
+        with trace_stage("dedup_chunks", items=len(chunks)):
+            chunks, _ = deduplicate_chunks(chunks)
     texts = [chunk["text"] for chunk in chunks]
     years = [chunk.get("year", 0) for chunk in chunks]
     return texts, years
 
+# --------------------------------------------------
+# Write faiss_index.idx, the text store and the
+# lexical index to an index version directory.
+# --------------------------------------------------
+def save_index(index, texts, years, path):
+    with trace_stage("save_index", items=len(texts)):
+        faiss.write_index(index, os.path.join(path, INDEX_FILE_NAME))
+        write_text_store(texts, years, path)
+    with trace_stage("build_lexical_index", items=len(texts)):
+        write_lexical_index(texts, os.path.join(path, LEXICAL_INDEX_NAME))
+
+# --------------------------------------------------
+# Open faiss_index.idx memory-mapped, so the vectors
+# are paged in from disk as searches touch them
+# rather than all read into RAM at startup.
+# (A mapped index is read-only.)
+# --------------------------------------------------
+def read_index_mmap(path):
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return faiss.read_index(path, flags)
+
+# --------------------------------------------------
+# Is the index version in path complete? (its texts
+# may still be in the texts_and_years.json of an older
+# build, converted when the version is opened)
+# --------------------------------------------------
+def index_version_exists(path):
+    return (os.path.exists(os.path.join(path, INDEX_FILE_NAME))
+            and (text_store_exists(path) or legacy_text_store_exists(path)))
+
+# --------------------------------------------------
+# Open the index version in path: returns (index,
+# texts, years), with the lexical index attached to
+# the FAISS index for hybrid retrieval
+# --------------------------------------------------
+def open_index_version(path):
+    with trace_stage("open_index") as stage:
+        index = read_index_mmap(os.path.join(path, INDEX_FILE_NAME))
+        check_index_type(index)
+        configure_search(index)
+
+        # Texts are read from the store on demand
+        if not text_store_exists(path):
+            convert_legacy_text_store(path)
+        texts, years = open_text_store(path)
+        stage.set(items=len(texts))
+
+        # (Indexes built before the lexical index was added)
+        lexical_dir = os.path.join(path, LEXICAL_INDEX_NAME)
+        if not lexical_index_exists(lexical_dir):
+            print("Building lexical index...")
+            with trace_stage("build_lexical_index", items=len(texts)):
+                write_lexical_index(texts, lexical_dir)
+        attach_lexical_index(index, open_lexical_index(lexical_dir))
+
+    return index, texts, years
+
+# --------------------------------------------------
+# Has a newer index been built since texts (from
+# load_or_build_index) was opened? If so, the running
+# assistant can switch to it with open_current_index()
+# --------------------------------------------------
+def newer_index_available(texts):
+    version = current_version()
+    return version is not None and version_dir(version) != texts.directory
+
+def open_current_index():
+    return open_index_version(version_dir(current_version()))
+
+# --------------------------------------------------
+# Group items from an iterable into lists of
+# batch_size (the last batch may be shorter)
+# --------------------------------------------------
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# --------------------------------------------------
+# Run a generator on a background thread, buffering
+# at most maxsize items ahead of the consumer.
+# Lets PDF parsing carry on while batches are being
+# embedded, without the buffer growing unbounded.
+# --------------------------------------------------
+def prefetch(items, maxsize):
+    buffer = queue.Queue(maxsize=maxsize)
+    done = object()
+    error = []
+
+    def producer():
+        try:
+            for item in items:
+                buffer.put(item)
+        except Exception as e:
+            error.append(e)
+        finally:
+            buffer.put(done)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    while True:
+        item = buffer.get()
+        if item is done:
+            break
+        yield item
+
+    thread.join()
+    if error:
+        raise error[0]
+
+# --------------------------------------------------
+# Streaming ingest: embed chunks and add them to the
+# FAISS index in fixed-size batches as they arrive.
+# chunks can be any iterable of {"year", "text"} dicts,
+# e.g. extract.iter_chunks(), so later PDFs are still
+# being parsed while earlier batches are embedded.
+# Only one batch of embeddings is held at a time.
+# on_batch(index, texts, years) is called after each
+# batch, so the partial index can already be searched.
+# Index types that need training (IVF) hold back the
+# first train_size embeddings to train on, then carry
+# on streaming.
+# --------------------------------------------------
+def build_index_streaming(model, chunks, batch_size=INGEST_BATCH_SIZE, on_batch=None,
+                          train_size=INDEX_TRAIN_SIZE):
+    index = None
+    pending = []
+    texts, years = [], []
+
+    batches = prefetch(iter_batches(chunks, batch_size), maxsize=INGEST_PREFETCH)
+    for batch in tqdm(batches, desc="Embedding batches", unit="batch"):
+        batch_texts = [chunk["text"] for chunk in batch]
+        with trace_stage("embed_documents", items=len(batch_texts)):
+            embeddings = embed_texts(model, batch_texts, workers=1, show_progress=False)
+
+        texts.extend(batch_texts)
+        years.extend(chunk.get("year", 0) for chunk in batch)
+
+        if index is None:
+            pending.append(embeddings)
+            if needs_training() and sum(len(e) for e in pending) < train_size:
+                continue
+            embeddings = np.vstack(pending)
+            pending = []
+            with trace_stage("train_faiss_index", items=len(embeddings)):
+                index = new_index(embeddings)
+        with trace_stage("faiss_add", items=len(embeddings)):
+            index.add(embeddings)
+
+        if on_batch is not None:
+            on_batch(index, texts, years)
+
+    # Fewer chunks than train_size: train on what there is
+    if pending:
+        with trace_stage("build_faiss_index", items=sum(len(e) for e in pending)):
+            index = build_faiss_index(np.vstack(pending))
+
+    if index is None:
+        raise ValueError("No chunks to index.")
+
+    return index, texts, years
+
+# --------------------------------------------------
+# on_batch callback for build_index_streaming that
+# publishes the partial index as a snapshot version
+# every `every` batches, so that a running assistant
+# or query service can already search the chunks
+# ingested so far (they switch to it as to any new
+# version). Only done while there is no complete
+# index to use: otherwise processes carry on with
+# that until the new build is complete. Once it is
+# published, remove() deletes the snapshots.
+# --------------------------------------------------
+class PartialIndexPublisher:
+
+    def __init__(self, every=INGEST_PUBLISH_EVERY):
+        self.every = every
+        self.batches = 0
+        self.versions = []
+
+    def __call__(self, index, texts, years):
+        self.batches += 1
+        if self.every <= 0 or self.batches % self.every:
+            return
+        if latest_complete_version() is not None:
+            return
+        version, path = new_version()
+        try:
+            save_index(index, texts, years, path)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        publish_version(version, path, snapshot=True)
+        self.versions.append(version)
+        print(f"\nPartial index of {len(texts)} chunks published (version {version})")
+
+    def remove(self):
+        current = current_version()
+        for version in self.versions:
+            if version != current:
+                shutil.rmtree(version_dir(version), ignore_errors=True)
+        self.versions = []
+
 # --------------------------------------------------
 # Load/build the model
+# model = embedding model (only needed for a build:
+# if None, the shared fp32 one from model_manager is used)
+# stream_from_pdfs = build by streaming chunks straight
+# from the PDFs in data/annual_reviews rather than
+# reading data/chunks.json
 # --------------------------------------------------
-def load_or_build_index(model, force_rebuild=False):
+def load_or_build_index(model=None, force_rebuild=False, stream_from_pdfs=False):
 
-    index_exists = os.path.exists(INDEX_FILE)
-    texts_exists = os.path.exists(TEXTS_FILE)
+    migrate_unversioned_index()
+    version = current_version()
 
-    # Build the model if the force_rebuild argument is set, 
-    # or if model files are not found.  
-    if force_rebuild or not (index_exists and texts_exists):
-        if force_rebuild:
-            print("Rebuild requested: deleting old model files if they exist...")
+    # Build the model if the force_rebuild argument is set,
+    # or if model files are not found.
+    # The new index is built alongside the current one, which
+    # stays in use (here and in any other running process)
+    # until the build is complete and published (a streaming
+    # ingest also publishes its partial index as it goes, if
+    # there is no complete one).
+    if force_rebuild or stream_from_pdfs or version is None or not index_version_exists(version_dir(version)):
+        if force_rebuild or stream_from_pdfs:
+            print("Rebuild requested: building a new version of the FAISS index...")
         else:
             print("Model files missing: building new FAISS index...")
 
-        # Delete old files if they exist
-        try:
-            if os.path.exists(INDEX_FILE):
-                os.remove(INDEX_FILE)
-            if os.path.exists(TEXTS_FILE):
-                os.remove(TEXTS_FILE)
-        except Exception as e:
-            print(f"Warning: problem deleting old files: {e}")
+        if model is None:
+            model = get_index_embedding_model()
 
-        # Build from scratch
-        texts, years = load_chunks(CHUNKS_FILE)
-        embeddings = []
-        for text in tqdm(texts, desc="Embedding texts"):
-            embeddings.append(model.encode(text, convert_to_numpy=True))
-        embeddings = np.vstack(embeddings)
+        version, path = new_version()
+        partial_versions = PartialIndexPublisher()
+        try:
+            if stream_from_pdfs:
+                # Imported here so that fitz is only needed for ingest
+                from extract import iter_chunks
+                chunks = iter_chunks(PDF_DIR)
+                if DEDUP_CHUNKS:
+                    removed_by_year = Counter()
+                    chunks = iter_unique_chunks(chunks, removed_by_year)
+                index, texts, years = build_index_streaming(model, chunks, on_batch=partial_versions)
+                if DEDUP_CHUNKS:
+                    print_dedup_report(removed_by_year, len(texts))
+            else:
+                # Build from scratch
+                texts, years = load_chunks(CHUNKS_FILE, dedup=DEDUP_CHUNKS)
+                with trace_stage("embed_documents", items=len(texts)):
+                    embeddings = get_embeddings(model, texts)
+                with trace_stage("build_faiss_index", items=len(embeddings)):
+                    index = build_faiss_index(embeddings)
 
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(embeddings)
+            save_index(index, texts, years, path)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            if partial_versions.versions:
+                print(f"[Warning] Build failed: the partial index {partial_versions.versions[-1]} stays in use "
+                      f"(there was no complete index) until the next rebuild")
+            raise
 
-        # Write faiss_index.idx and texts_and_years.json to
-        # models/assistant directory.
-        faiss.write_index(index, INDEX_FILE)
-        with open(TEXTS_FILE, "w") as f:
-            json.dump([{"text": t, "year": y} for t, y in zip(texts, years)], f)
+        publish_version(version, path)
+        partial_versions.remove()
+        print(f"Index version {version} is now in use.")
 
     # Otherwise, load the existing model.
     else:
         print("Loading existing FAISS index and texts...")
-        index = faiss.read_index(INDEX_FILE)
-        with open(TEXTS_FILE, "r") as f:
-            saved = json.load(f)
-        texts = [item["text"] for item in saved]
-        years = [item["year"] for item in saved]
+        if not is_complete_version(version):
+            print(f"[Warning] Index version {version} is the partial index of an interrupted ingest: "
+                  f"run with --ingest to build the complete index")
 
-    return index, texts, years
\ No newline at end of file
+    return open_index_version(version_dir(version))
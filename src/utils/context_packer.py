@@ -0,0 +1,126 @@
+# ==================================================================
+# Packs retrieved chunks into the context of a RAG prompt.
+# From the retrieved candidates (best first, already cut at the
+# first large distance gap by retrieve) it:
+#  1. drops near-duplicates of a chunk already selected, and trims
+#     text that overlaps one (chunks built with CHUNK_OVERLAP_TOKENS
+#     repeat their neighbour's tail)
+#  2. adds chunks until RAG_CONTEXT_TOKENS (counted with the LLM's
+#     own tokenizer) is used up
+# ==================================================================
+
+from functools import lru_cache
+from assistant_config import RAG_MODEL, RAG_CONTEXT_TOKENS, RAG_DUPLICATE_THRESHOLD, RAG_MIN_OVERLAP_WORDS
+from utils.dedup_helpers import shingle_hashes
+
+SEPARATOR = "\n\n"
+
+# --------------------------------------------------
+# Token counter for the LLM (tiktoken encoding for
+# the model, or cl100k_base for names it doesn't know)
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def load_llm_token_counter(model_name=RAG_MODEL):
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(text):
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return count_tokens
+
+# --------------------------------------------------
+# Remove from words any prefix that repeats the end
+# of other, and any suffix that repeats its start
+# (only runs of at least min_words count)
+# --------------------------------------------------
+def trim_overlap(words, other, min_words=RAG_MIN_OVERLAP_WORDS):
+    for n in range(min(len(words), len(other)), min_words - 1, -1):
+        if words[:n] == other[-n:]:
+            words = words[n:]
+            break
+    for n in range(min(len(words), len(other)), min_words - 1, -1):
+        if words[-n:] == other[:n]:
+            words = words[:-n]
+            break
+    return words
+
+# --------------------------------------------------
+# Jaccard similarity of the word shingles of two texts
+# --------------------------------------------------
+def shingle_similarity(a, b):
+    a, b = set(a.tolist()), set(b.tolist())
+    return len(a & b) / max(1, len(a | b))
+
+# --------------------------------------------------
+# Cut text down to at most max_tokens tokens (by words)
+# --------------------------------------------------
+def truncate_to_tokens(text, max_tokens, count_tokens):
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid])) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo])
+
+# --------------------------------------------------
+# Select and trim chunks for the prompt context.
+# D, I = distances and ids of the retrieved chunks,
+# best first (as returned by retrieve). Returns the chunk texts to use and
+# a dict of stats: chunks used, candidates, context
+# tokens, and tokens saved against joining every
+# retrieved chunk.
+# --------------------------------------------------
+def pack_context(D, I, texts, budget=RAG_CONTEXT_TOKENS, count_tokens=None):
+    count_tokens = count_tokens or load_llm_token_counter()
+    candidates = [texts[i] for i in I]
+    full_tokens = count_tokens(SEPARATOR.join(candidates))
+
+    selected, selected_words, selected_shingles = [], [], []
+    used = 0
+    separator_tokens = count_tokens(SEPARATOR)
+
+    for text in candidates:
+        shingles = shingle_hashes(text)
+        if any(shingle_similarity(shingles, s) >= RAG_DUPLICATE_THRESHOLD for s in selected_shingles):
+            continue
+
+        words = text.split()
+        n_words = len(words)
+        for other in selected_words:
+            words = trim_overlap(words, other)
+        # Drop what little is left of a chunk that was mostly overlap
+        # (short chunks that weren't trimmed are kept as they are)
+        if not words or (len(words) < n_words and len(words) < RAG_MIN_OVERLAP_WORDS):
+            continue
+        text = " ".join(words)
+
+        tokens = count_tokens(text) + (separator_tokens if selected else 0)
+        if used + tokens > budget:
+            if selected:
+                continue  # a later, shorter chunk may still fit
+            text = truncate_to_tokens(text, budget, count_tokens)
+            if not text:
+                continue
+            tokens = count_tokens(text)
+
+        selected.append(text)
+        selected_words.append(words)
+        selected_shingles.append(shingles)
+        used += tokens
+
+    context_tokens = count_tokens(SEPARATOR.join(selected))
+    stats = {
+        "chunks": len(selected),
+        "candidates": len(candidates),
+        "context_tokens": context_tokens,
+        "tokens_saved": full_tokens - context_tokens,
+    }
+    return selected, stats
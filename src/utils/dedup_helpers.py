@@ -0,0 +1,102 @@
+# ==================================================================
+# Near-duplicate chunk removal with MinHash/LSH.
+# Annual reviews repeat a lot of text from year to year (board
+# lists, office addresses, member airline rosters), which would
+# otherwise be embedded, indexed and clustered many times over.
+# ==================================================================
+
+import re
+import zlib
+from collections import Counter
+import numpy as np
+from assistant_config import DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_BANDS, DEDUP_SHINGLE_SIZE
+
+# Mersenne prime used for the MinHash permutations.
+# Shingle hashes are 32-bit, so a * x + b stays within uint64.
+_PRIME = np.uint64((1 << 31) - 1)
+
+# --------------------------------------------------
+# Random (but fixed) hash permutations
+# --------------------------------------------------
+def make_permutations(num_perm=DEDUP_NUM_PERM, seed=42):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+    return a, b
+
+# --------------------------------------------------
+# Hashed word shingles of a text (lowercased, with
+# numbers collapsed so page numbers and years don't
+# make otherwise identical text look different)
+# --------------------------------------------------
+def shingle_hashes(text, size=DEDUP_SHINGLE_SIZE):
+    words = re.sub(r"\d+", "0", text.lower()).split()
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles),
+                       dtype=np.uint64, count=len(shingles))
+
+# --------------------------------------------------
+# MinHash signature: for each permutation, the minimum
+# permuted hash over all shingles
+# --------------------------------------------------
+def minhash_signature(text, permutations):
+    a, b = permutations
+    hashes = shingle_hashes(text) % _PRIME
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % _PRIME).min(axis=1)
+
+# --------------------------------------------------
+# Generator that drops chunks whose estimated Jaccard
+# similarity to an earlier chunk is at least threshold.
+# Signatures are split into bands, and chunks sharing
+# any band are compared, so each chunk is only checked
+# against a few candidates rather than every earlier one.
+# Works on any iterable of {"year", "text"} dicts, so it
+# can sit inside the streaming ingest.
+# removed_by_year (a Counter) is updated as chunks are
+# dropped.
+# --------------------------------------------------
+def iter_unique_chunks(chunks, removed_by_year=None, threshold=DEDUP_THRESHOLD,
+                       num_perm=DEDUP_NUM_PERM, bands=DEDUP_BANDS):
+    permutations = make_permutations(num_perm)
+    rows = num_perm // bands
+    buckets = [{} for _ in range(bands)]
+    signatures = []
+
+    for chunk in chunks:
+        signature = minhash_signature(chunk["text"], permutations)
+        keys = [signature[i * rows:(i + 1) * rows].tobytes() for i in range(bands)]
+
+        candidates = {c for i, key in enumerate(keys) for c in buckets[i].get(key, ())}
+        if any(np.mean(signatures[c] == signature) >= threshold for c in candidates):
+            if removed_by_year is not None:
+                removed_by_year[chunk.get("year", "unknown")] += 1
+            continue
+
+        idx = len(signatures)
+        signatures.append(signature)
+        for i, key in enumerate(keys):
+            buckets[i].setdefault(key, []).append(idx)
+        yield chunk
+
+# --------------------------------------------------
+# Print how many chunks were removed for each year
+# --------------------------------------------------
+def print_dedup_report(removed_by_year, n_kept):
+    n_removed = sum(removed_by_year.values())
+    print(f"Deduplication: removed {n_removed} near-duplicate chunks, kept {n_kept}")
+    for year in sorted(removed_by_year, key=str):
+        print(f"  {year}: {removed_by_year[year]} removed")
+
+# --------------------------------------------------
+# Remove near-duplicate chunks from a list of
+# {"year", "text"} dicts, keeping the first occurrence.
+# Returns the kept chunks and the removals per year.
+# --------------------------------------------------
+def deduplicate_chunks(chunks, threshold=DEDUP_THRESHOLD, verbose=True):
+    removed_by_year = Counter()
+    kept = list(iter_unique_chunks(chunks, removed_by_year, threshold=threshold))
+    if verbose:
+        print_dedup_report(removed_by_year, len(kept))
+    return kept, removed_by_year
@@ -0,0 +1,212 @@
+# ==================================================================
+# Persistent embedding store shared by the assistant, the BERTopic
+# training notebook and the grid search.
+# Embeddings are keyed by (model name, hash of the chunk text), so
+# each chunk is only ever embedded once per model. Vectors live in
+# a flat float32 file that is read memory-mapped.
+#
+# Layout: models/embeddings/<model>[_normalised]/
+#    vectors.f32 : float32 rows, one per key, appended to
+#    keys.txt    : SHA-1 of each row's text, one per line
+#    meta.json   : model name, dimension, normalisation
+#    lock        : flock'ed by writers (exclusive) and readers (shared),
+#                  as the notebooks, grid search and assistant share it
+# ==================================================================
+
+import os
+import json
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+from assistant_config import EMBEDDING_MODEL, EMBEDDING_STORE_DIR, EMBED_BATCH_SIZE, EMBED_WORKERS, NORMALISE_EMBEDDINGS
+
+try:
+    import fcntl
+except ImportError:  # (Windows: no locking)
+    fcntl = None
+
+# --------------------------------------------------
+# Embed a list of texts in batches.
+# Texts are sorted by length (longest first) before
+# batching, so each batch pads to similar lengths,
+# and the embeddings are returned in the original order.
+# workers > 1 spreads the batches over a pool of CPU
+# processes (worth it for large corpora only, as each
+# process loads its own copy of the model).
+# Embeddings are L2-normalised if NORMALISE_EMBEDDINGS
+# (queries must be encoded the same way), so the index
+# metric can be switched between L2 and inner product.
+# --------------------------------------------------
+def embed_texts(model, texts, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS, show_progress=True):
+    order = np.argsort([-len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[i] for i in order]
+
+    if workers > 1:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+        try:
+            sorted_embeddings = model.encode_multi_process(sorted_texts, pool, batch_size=batch_size,
+                                                           normalize_embeddings=NORMALISE_EMBEDDINGS)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        sorted_embeddings = model.encode(sorted_texts, batch_size=batch_size, convert_to_numpy=True,
+                                         normalize_embeddings=NORMALISE_EMBEDDINGS,
+                                         show_progress_bar=show_progress)
+
+    embeddings = np.empty_like(sorted_embeddings, dtype=np.float32)
+    embeddings[order] = sorted_embeddings
+    return embeddings
+
+# --------------------------------------------------
+# Key for a chunk of text
+# --------------------------------------------------
+def text_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# --------------------------------------------------
+# Directory holding the store for a given model
+# --------------------------------------------------
+def store_dir(model_name=EMBEDDING_MODEL):
+    name = model_name.replace("/", "__")
+    if NORMALISE_EMBEDDINGS:
+        name += "_normalised"
+    return os.path.join(EMBEDDING_STORE_DIR, name)
+
+# --------------------------------------------------
+# Hold the store's lock file: exclusive for writing,
+# shared for reading
+# --------------------------------------------------
+@contextmanager
+def store_lock(path, exclusive=False):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# --------------------------------------------------
+# Keys and number of complete vector rows on disk
+# (call with the lock held)
+# --------------------------------------------------
+def _read_store(vectors_file, keys_file, dim):
+    keys = []
+    if os.path.exists(keys_file):
+        with open(keys_file, "r") as f:
+            keys = f.read().split()
+    n_vectors = os.path.getsize(vectors_file) // (4 * dim) if os.path.exists(vectors_file) else 0
+    return keys, n_vectors
+
+# --------------------------------------------------
+# Open the store for a model.
+# Returns (dict of key -> row, memory-mapped vectors),
+# or ({}, None) if nothing has been stored yet.
+# If a previous write was interrupted, only rows that
+# have both a key and a full vector are used. Keys
+# without vectors can't come from an interrupted
+# write (vectors are written first), so a store with
+# more keys than vectors is not used.
+# --------------------------------------------------
+def open_store(model_name=EMBEDDING_MODEL):
+    path = store_dir(model_name)
+    meta_file = os.path.join(path, "meta.json")
+    keys_file = os.path.join(path, "keys.txt")
+    vectors_file = os.path.join(path, "vectors.f32")
+    if not all(os.path.exists(f) for f in (meta_file, keys_file, vectors_file)):
+        return {}, None
+
+    with open(meta_file, "r") as f:
+        dim = json.load(f)["dim"]
+    with store_lock(path):
+        keys, n_vectors = _read_store(vectors_file, keys_file, dim)
+
+    if len(keys) > n_vectors:
+        print(f"[Warning] Embedding store {path} has {len(keys)} keys but {n_vectors} vectors: not using it")
+        return {}, None
+    n_rows = len(keys)
+    if n_rows == 0:
+        return {}, None
+
+    vectors = np.memmap(vectors_file, dtype=np.float32, mode="r", shape=(n_rows, dim))
+    rows = {key: i for i, key in enumerate(keys[:n_rows])}
+    return rows, vectors
+
+# --------------------------------------------------
+# Append new vectors (and their keys) to the store.
+# Vectors are written before keys, so a crash part
+# way through never leaves a key without its vector.
+# The whole check-truncate-append runs under the
+# exclusive lock, so concurrent writers (e.g. a
+# notebook and the grid search) can't interleave,
+# and keys another writer added meanwhile are skipped.
+# --------------------------------------------------
+def append_to_store(keys, vectors, model_name=EMBEDDING_MODEL):
+    path = store_dir(model_name)
+    dim = int(vectors.shape[1])
+    meta_file = os.path.join(path, "meta.json")
+    vectors_file = os.path.join(path, "vectors.f32")
+    keys_file = os.path.join(path, "keys.txt")
+
+    with store_lock(path, exclusive=True):
+        if not os.path.exists(meta_file):
+            with open(meta_file, "w") as f:
+                json.dump({"model": model_name, "dim": dim, "normalised": NORMALISE_EMBEDDINGS}, f)
+
+        old_keys, n_vectors = _read_store(vectors_file, keys_file, dim)
+        if len(old_keys) > n_vectors:
+            print(f"[Warning] Embedding store {path} has {len(old_keys)} keys but {n_vectors} vectors: resetting it")
+            old_keys = []
+
+        # Drop anything left over from an interrupted write
+        # beyond the rows that are known to be complete
+        n_rows = len(old_keys)
+        if os.path.exists(vectors_file) and os.path.getsize(vectors_file) != n_rows * 4 * dim:
+            with open(vectors_file, "r+b") as f:
+                f.truncate(n_rows * 4 * dim)
+        if n_rows == 0 and os.path.exists(keys_file):
+            open(keys_file, "w").close()
+
+        known = set(old_keys)
+        new = [j for j, key in enumerate(keys) if key not in known]
+        if not new:
+            return
+
+        with open(vectors_file, "ab") as f:
+            f.write(np.ascontiguousarray(vectors[new], dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(keys_file, "a") as f:
+            f.write("".join(keys[j] + "\n" for j in new))
+
+# --------------------------------------------------
+# Get embeddings for a list of texts, reading those
+# already in the store and only embedding unseen ones
+# (which are then added to the store).
+# Returns a float32 array with one row per text.
+# --------------------------------------------------
+def get_embeddings(model, texts, model_name=EMBEDDING_MODEL, workers=EMBED_WORKERS):
+    rows, vectors = open_store(model_name)
+    keys = [text_key(text) for text in texts]
+
+    # Unique unseen texts, in order of first appearance
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in rows and key not in missing:
+            missing[key] = text
+
+    n_cached = len(texts) - sum(1 for key in keys if key in missing)
+    print(f"Embedding store: {n_cached} of {len(texts)} texts already embedded, "
+          f"embedding {len(missing)} new texts")
+
+    if missing:
+        new_vectors = embed_texts(model, list(missing.values()), workers=workers)
+        append_to_store(list(missing), new_vectors, model_name)
+        rows, vectors = open_store(model_name)
+
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
+    return np.asarray(vectors[[rows[key] for key in keys]], dtype=np.float32)
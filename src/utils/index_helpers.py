@@ -0,0 +1,292 @@
+# ==================================================================
+# Helper functions to build and search the FAISS index used by
+# assistant.py, with the index type and metric set in
+# src/assistant_config.py:
+#    flat     : exact search (scans every vector)
+#    hnsw     : graph-based approximate search
+#    ivf_flat : inverted lists, full vectors
+#    ivf_pq   : inverted lists, product-quantised vectors
+# Metrics: "l2" (Euclidean) or "ip" (inner product, i.e. cosine
+# similarity when embeddings are normalised).
+# ==================================================================
+
+import faiss
+import numpy as np
+from assistant_config import INDEX_TYPE, INDEX_METRIC, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH
+from assistant_config import IVF_NLIST, IVF_NPROBE, PQ_M, PQ_NBITS, NORMALISE_EMBEDDINGS
+from assistant_config import HYBRID_SEARCH, HYBRID_CANDIDATES, THRESHOLD
+from utils.lexical_index import rrf_fuse
+from utils.tracing import trace_stage
+
+INDEX_TYPES = ["flat", "hnsw", "ivf_flat", "ivf_pq"]
+
+# (FAISS index, lexical index of the same chunks) for the
+# most recently loaded indexes, newest last (FAISS objects
+# can't carry extra attributes)
+_lexical_indexes = []
+
+# FAISS class behind each index type
+_INDEX_CLASSES = {
+    "flat": ("IndexFlatL2", "IndexFlatIP", "IndexFlat"),
+    "hnsw": ("IndexHNSWFlat",),
+    "ivf_flat": ("IndexIVFFlat",),
+    "ivf_pq": ("IndexIVFPQ",),
+}
+
+# --------------------------------------------------
+# Map the metric name to the FAISS constant
+# --------------------------------------------------
+def faiss_metric(metric=INDEX_METRIC):
+    if metric == "l2":
+        return faiss.METRIC_L2
+    if metric in ("ip", "cosine"):
+        return faiss.METRIC_INNER_PRODUCT
+    raise ValueError(f"Unknown index metric '{metric}' (use 'l2' or 'ip')")
+
+# --------------------------------------------------
+# Does this index type need training before use?
+# --------------------------------------------------
+def needs_training(index_type=INDEX_TYPE):
+    return index_type.startswith("ivf")
+
+# --------------------------------------------------
+# Create an empty index of the configured type, and
+# train it on train_embeddings if the type needs it.
+# The number of IVF lists defaults to 4 * sqrt(n)
+# (capped so each list gets ~39 training points, as
+# FAISS recommends).
+# --------------------------------------------------
+def new_index(train_embeddings, index_type=INDEX_TYPE, metric=INDEX_METRIC):
+    n, dim = train_embeddings.shape
+    metric_type = faiss_metric(metric)
+
+    if index_type == "flat":
+        index = faiss.IndexFlat(dim, metric_type)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, metric_type)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = IVF_NLIST or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n // 39))
+        quantizer = faiss.IndexFlat(dim, metric_type)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric_type)
+        else:
+            # Each PQ codebook has 2^nbits centroids, which
+            # also want ~39 training points each
+            nbits = max(1, min(PQ_NBITS, int(np.log2(max(n // 39, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_M, nbits, metric_type)
+        index.train(np.ascontiguousarray(train_embeddings, dtype=np.float32))
+    else:
+        raise ValueError(f"Unknown index type '{index_type}' (use one of {INDEX_TYPES})")
+
+    configure_search(index)
+    return index
+
+# --------------------------------------------------
+# Build an index of the configured type over a full
+# set of embeddings
+# --------------------------------------------------
+def build_faiss_index(embeddings, index_type=INDEX_TYPE, metric=INDEX_METRIC):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    index = new_index(embeddings, index_type=index_type, metric=metric)
+    index.add(embeddings)
+    return index
+
+# --------------------------------------------------
+# Apply the query-time settings from the config
+# (so they can be changed without a rebuild)
+# --------------------------------------------------
+def configure_search(index):
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = IVF_NPROBE
+    return index
+
+# --------------------------------------------------
+# Warn if an index loaded from disk is not of the
+# type set in the config
+# --------------------------------------------------
+def check_index_type(index, index_type=INDEX_TYPE, metric=INDEX_METRIC):
+    name = type(faiss.downcast_index(index)).__name__
+    if name not in _INDEX_CLASSES.get(index_type, ()) or index.metric_type != faiss_metric(metric):
+        print(f"[Warning] Saved index is a {name} but INDEX_TYPE='{index_type}', "
+              f"INDEX_METRIC='{metric}'. Run with --rebuild to apply the new settings.")
+
+# --------------------------------------------------
+# Boolean mask over index IDs of the chunks within a
+# year range (same semantics as filter_dataframe_by_year)
+# Returns None if no filter is set.
+# --------------------------------------------------
+def year_mask(years, min_year=None, max_year=None, exclude_years=None):
+    if min_year is None and max_year is None and not exclude_years:
+        return None
+    years = np.asarray(years)
+    mask = np.ones(len(years), dtype=bool)
+    if min_year is not None:
+        mask &= years >= int(min_year)
+    if max_year is not None:
+        mask &= years <= int(max_year)
+    if exclude_years:
+        mask &= ~np.isin(years, [int(y) for y in exclude_years])
+    return mask
+
+# --------------------------------------------------
+# Search parameters restricting the search to the IDs
+# in mask. The approximate indexes widen their search
+# (efSearch, nprobe) in proportion to how much of the
+# corpus is filtered out, so narrow filters still
+# return a full top-k.
+# Returns (params, bitmap): the bitmap must be kept
+# alive until the search has run.
+# --------------------------------------------------
+def filter_params(index, mask, k):
+    bitmap = np.packbits(mask, bitorder="little")
+    selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+    fraction = max(mask.mean(), 1.0 / len(mask))
+
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw"):
+        ef_search = min(index.ntotal, max(index.hnsw.efSearch, k, int(index.hnsw.efSearch / fraction)))
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    elif hasattr(index, "nprobe"):
+        nprobe = min(index.nlist, max(index.nprobe, int(np.ceil(index.nprobe / fraction))))
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    else:
+        # Flat: only the selected vectors are compared
+        params = faiss.SearchParameters(sel=selector)
+    return params, bitmap
+
+# --------------------------------------------------
+# Search the index.
+# Returns (D, I) as index.search does, but with inner
+# product scores converted to squared L2 distances
+# (exact for normalised embeddings), so that results
+# are always sorted by increasing distance and the
+# THRESHOLD gap logic works for either metric.
+# mask (from year_mask) limits the search to the
+# selected IDs.
+# Missing results (possible with IVF or a narrow
+# mask) have index -1.
+# --------------------------------------------------
+def search_index(index, query_embeddings, k, mask=None):
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+    if query_embeddings.ndim == 1:
+        query_embeddings = query_embeddings[None, :]
+
+    if mask is None:
+        D, I = index.search(query_embeddings, k)
+    elif not mask.any():
+        D = np.full((len(query_embeddings), k), np.inf, dtype=np.float32)
+        I = np.full((len(query_embeddings), k), -1, dtype=np.int64)
+    else:
+        params, bitmap = filter_params(index, mask, k)
+        D, I = index.search(query_embeddings, k, params=params)
+
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        D = np.where(I >= 0, 2.0 - 2.0 * D, np.inf).astype(np.float32)
+    return D, I
+
+# --------------------------------------------------
+# Function to dynamically determine optimal number
+# of documents to summarise, based on distance jumps
+# threshold = minimum jump size to consider a 'gap'
+# --------------------------------------------------
+def dynamic_top_k(distances, threshold=THRESHOLD):
+
+    distances = np.array(distances)
+    diffs = np.diff(distances)
+
+    for idx, diff in enumerate(diffs):
+        #print(idx, ": Distance = ", distances[idx], " : Difference wrt next element: ", diffs[idx])
+        if diff > threshold:
+            #print ("Keeping ", idx+1, " text elements for summarising")
+            return idx + 1 
+        
+    #print("No large gap found. Keeping all ", len(distances), "matches")
+    return len(distances)
+
+# --------------------------------------------------
+# Embed a list of text queries in one model.encode
+# --------------------------------------------------
+def encode_queries(model, queries):
+    with trace_stage("embed_queries", items=len(queries)):
+        return model.encode(list(queries), convert_to_numpy=True,
+                            normalize_embeddings=NORMALISE_EMBEDDINGS)
+
+# --------------------------------------------------
+# Pair a FAISS index with the lexical index of the
+# same chunks, for hybrid retrieval
+# --------------------------------------------------
+def attach_lexical_index(index, lexical, keep=4):
+    global _lexical_indexes
+    pairs = [(i, lex) for i, lex in _lexical_indexes if i is not index]
+    _lexical_indexes = pairs[-(keep - 1):] + [(index, lexical)]
+
+def attached_lexical_index(index):
+    for i, lexical in _lexical_indexes:
+        if i is index:
+            return lexical
+    return None
+
+# --------------------------------------------------
+# Distances (as returned by search_index) between one
+# query embedding and the stored vectors of ids
+# (approximate for ivf_pq, which stores codes)
+# --------------------------------------------------
+def vector_distances(index, query_embedding, ids):
+    index = faiss.downcast_index(index)
+    if hasattr(index, "make_direct_map") and index.direct_map.type == faiss.DirectMap.NoMap:
+        index.make_direct_map()
+    vectors = index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return (2.0 - 2.0 * vectors @ query_embedding).astype(np.float32)
+    return ((vectors - query_embedding) ** 2).sum(axis=1).astype(np.float32)
+
+# --------------------------------------------------
+# Retrieve the top_k chunks for a list of text queries
+# with one model.encode and one index search for the
+# whole batch (query_embeddings = already encoded).
+# The FAISS matches are cut at the first large
+# distance gap (dynamic_top_k).
+# With hybrid (and a lexical index attached), the
+# HYBRID_CANDIDATES best FAISS results (cut at the gap)
+# and BM25 results are combined by reciprocal rank
+# fusion, and as many fused results as the gap cut
+# kept (at most top_k) are returned in fused order
+# with their embedding distances: keyword matches the
+# embedding model ranks low (acronyms, exact terms)
+# can take the place of weaker FAISS matches, but
+# don't add to how many snippets are used.
+# Returns one (distances, ids) pair per query, best
+# first, with missing results dropped.
+# --------------------------------------------------
+def retrieve(model, index, queries, top_k, mask=None, query_embeddings=None, hybrid=HYBRID_SEARCH):
+    if not len(queries):
+        return []
+    if query_embeddings is None:
+        query_embeddings = encode_queries(model, queries)
+
+    lexical = attached_lexical_index(index) if hybrid else None
+    n_dense = top_k if lexical is None else max(top_k, HYBRID_CANDIDATES)
+    with trace_stage("faiss_search", items=len(queries)):
+        D, I = search_index(index, query_embeddings, n_dense, mask=mask)
+
+    results = []
+    for query, embedding, d, i in zip(queries, query_embeddings, D, I):
+        d, i = d[i >= 0], i[i >= 0]
+        keep = dynamic_top_k(d)
+        if lexical is None:
+            results.append((d[:keep], i[:keep]))
+            continue
+
+        with trace_stage("bm25_search", items=1):
+            _, lexical_ids = lexical.search(query, max(top_k, HYBRID_CANDIDATES), mask=mask)
+        with trace_stage("rrf_fuse", items=1):
+            _, ids = rrf_fuse([i[:keep], lexical_ids])
+            ids = ids[:min(keep, top_k)]
+            results.append((vector_distances(index, embedding, ids), ids))
+    return results
@@ -0,0 +1,174 @@
+# ==================================================================
+# Versioned index builds.
+# Each build of the FAISS index, text store and lexical index is
+# written to its own directory, and only made current once complete,
+# by atomically replacing the pointer file with the new version's
+# name. Until then, processes keep using the previous version (whose
+# files are never modified), and a build that fails or is killed
+# part way leaves the current version untouched.
+# Running processes can poll current_version() and switch to a new
+# version when one is published.
+# A streaming ingest can also publish snapshots of its partial index,
+# but only while there is no complete version to use instead: they
+# are marked as such, and never take the place of a complete build.
+#
+# Layout: models/assistant/
+#    current_index                  : name of the version in use
+#    index_versions/<version>/      : one complete build
+#    index_versions/<version>.partial/ : a build in progress
+#    index_versions/<version>/snapshot : marks a partial index snapshot
+# ==================================================================
+
+import os
+import time
+import shutil
+from assistant_config import MODEL_DIR, INDEX_VERSIONS_DIR, CURRENT_INDEX_FILE, INDEX_KEEP_VERSIONS
+from assistant_config import INDEX_FILE_NAME, TEXTS_FILE_NAME, TEXT_OFFSETS_FILE_NAME, YEARS_FILE_NAME
+from assistant_config import LEXICAL_INDEX_NAME, LEGACY_TEXTS_FILE_NAME
+from utils.text_store import text_store_exists, legacy_text_store_exists, convert_legacy_text_store
+
+PARTIAL_SUFFIX = ".partial"
+SNAPSHOT_MARKER = "snapshot"
+
+# --------------------------------------------------
+# Directory of a version
+# --------------------------------------------------
+def version_dir(version):
+    return os.path.join(INDEX_VERSIONS_DIR, version)
+
+# --------------------------------------------------
+# Name of the version in use (None if no index has
+# been built yet)
+# --------------------------------------------------
+def current_version():
+    try:
+        with open(CURRENT_INDEX_FILE, "r") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version if version and os.path.isdir(version_dir(version)) else None
+
+# --------------------------------------------------
+# Is a version a complete build (not a snapshot of a
+# partial index)?
+# --------------------------------------------------
+def is_complete_version(version):
+    return not os.path.exists(os.path.join(version_dir(version), SNAPSHOT_MARKER))
+
+# --------------------------------------------------
+# Published versions, oldest first
+# --------------------------------------------------
+def list_versions():
+    if not os.path.isdir(INDEX_VERSIONS_DIR):
+        return []
+    return sorted(name for name in os.listdir(INDEX_VERSIONS_DIR)
+                  if not name.endswith(PARTIAL_SUFFIX) and os.path.isdir(version_dir(name)))
+
+# --------------------------------------------------
+# Name of the newest complete build (None if there
+# is none)
+# --------------------------------------------------
+def latest_complete_version():
+    complete = [version for version in list_versions() if is_complete_version(version)]
+    return complete[-1] if complete else None
+
+# --------------------------------------------------
+# Start a new version: returns its name and the
+# (partial) directory to write the build to
+# --------------------------------------------------
+def new_version():
+    prune_partial_versions()
+    # (milliseconds, so that the partial versions published
+    # during a streaming ingest get names of their own)
+    while True:
+        now = time.time()
+        version = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"{int(now * 1000) % 1000:03d}-{os.getpid()}"
+        path = version_dir(version) + PARTIAL_SUFFIX
+        if not os.path.exists(path) and not os.path.exists(version_dir(version)):
+            break
+        time.sleep(0.001)
+    os.makedirs(path)
+    return version, path
+
+# --------------------------------------------------
+# Make a completed build the current version:
+# rename its directory, then switch the pointer
+# (os.replace is atomic, so readers see either the
+# old or the new version, never neither).
+# snapshot = the build is a partial index
+# Returns the version's directory.
+# --------------------------------------------------
+def publish_version(version, path, snapshot=False):
+    if snapshot:
+        open(os.path.join(path, SNAPSHOT_MARKER), "w").close()
+    final_path = version_dir(version)
+    os.replace(path, final_path)
+
+    tmp_file = CURRENT_INDEX_FILE + f".{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, CURRENT_INDEX_FILE)
+
+    prune_versions()
+    return final_path
+
+# --------------------------------------------------
+# Delete all but the newest keep versions (never the
+# current one, nor the newest complete build, which
+# snapshots of a partial index don't replace).
+# Processes still using an older version keep its
+# open (memory-mapped) files on POSIX systems; where
+# files in use can't be deleted, they are left for a
+# later prune.
+# --------------------------------------------------
+def prune_versions(keep=INDEX_KEEP_VERSIONS):
+    protected = {current_version(), latest_complete_version()}
+    versions = list_versions()
+    for version in versions[:-keep] if keep > 0 else versions:
+        if version not in protected:
+            shutil.rmtree(version_dir(version), ignore_errors=True)
+
+# --------------------------------------------------
+# Delete builds left partial by processes that are
+# no longer running
+# --------------------------------------------------
+def prune_partial_versions():
+    if not os.path.isdir(INDEX_VERSIONS_DIR):
+        return
+    for name in os.listdir(INDEX_VERSIONS_DIR):
+        if name.endswith(PARTIAL_SUFFIX) and not _process_running(name[:-len(PARTIAL_SUFFIX)].rsplit("-", 1)[-1]):
+            print(f"Removing incomplete index build {name}")
+            shutil.rmtree(version_dir(name), ignore_errors=True)
+
+def _process_running(pid):
+    if not pid.isdigit() or os.name == "nt":
+        return True  # can't tell: leave it
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# --------------------------------------------------
+# Move an index built before versioning (files in
+# models/assistant itself) into a version of its own
+# --------------------------------------------------
+def migrate_unversioned_index():
+    names = [INDEX_FILE_NAME, TEXTS_FILE_NAME, TEXT_OFFSETS_FILE_NAME, YEARS_FILE_NAME,
+             LEXICAL_INDEX_NAME, LEGACY_TEXTS_FILE_NAME]
+    found = [name for name in names if os.path.exists(os.path.join(MODEL_DIR, name))]
+    if current_version() is not None or INDEX_FILE_NAME not in found:
+        return
+
+    print("Moving the existing index into a versioned directory...")
+    version, path = new_version()
+    for name in found:
+        os.replace(os.path.join(MODEL_DIR, name), os.path.join(path, name))
+    # (while the version is still private to this process)
+    if not text_store_exists(path) and legacy_text_store_exists(path):
+        convert_legacy_text_store(path)
+    publish_version(version, path)
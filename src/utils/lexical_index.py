@@ -0,0 +1,158 @@
+# ==================================================================
+# Lexical (BM25) index over the chunks behind the FAISS index, for
+# exact-term queries (acronyms such as SAF, NDC, IOSA, CORSIA) that
+# the embedding model handles poorly.
+# Chunks are tokenised as the topic-model vectorizers do (lowercase,
+# TOKEN_PATTERN, minus CUSTOM_STOPWORDS), and each term's postings
+# (chunk IDs and term counts) are stored back to back, CSR-style,
+# so a query only touches the postings of its own terms.
+# Searching needs no embedding model, only these files.
+#
+# Layout: lexical_index/ in the index version directory
+#    vocabulary.json  : terms (term i = row i) and the token pattern
+#    term_offsets.npy : int64 start of each term's postings (plus the end)
+#    postings.npy     : int32 chunk IDs, grouped by term
+#    term_counts.npy  : uint16 count of the term in each of those chunks
+#    doc_lengths.npy  : int32 number of (non-stopword) terms in each chunk
+# ==================================================================
+
+import os
+import re
+import json
+import numpy as np
+from collections import Counter
+from assistant_config import BM25_K1, BM25_B, RRF_K
+
+_FILES = ("term_offsets", "postings", "term_counts", "doc_lengths")
+
+# --------------------------------------------------
+# Split text into the terms of the index
+# --------------------------------------------------
+def tokenise(text, pattern, stopwords=frozenset()):
+    return [t for t in pattern.findall(text.lower()) if t not in stopwords]
+
+# --------------------------------------------------
+# Build the index over the chunk texts (row i of the
+# FAISS index is chunk i) and write it to index_dir
+# --------------------------------------------------
+def write_lexical_index(texts, index_dir):
+    # Imported here so that searching doesn't need scikit-learn
+    from utils.stopwords import CUSTOM_STOPWORDS, TOKEN_PATTERN
+
+    pattern = re.compile(TOKEN_PATTERN)
+    stopwords = frozenset(CUSTOM_STOPWORDS)
+
+    vocabulary = {}
+    term_ids, doc_ids, counts, doc_lengths = [], [], [], []
+    for doc_id, text in enumerate(texts):
+        terms = Counter(tokenise(text, pattern, stopwords))
+        doc_lengths.append(sum(terms.values()))
+        for term, count in terms.items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            doc_ids.append(doc_id)
+            counts.append(count)
+
+    # Group the postings by term (chunk IDs stay in order within a term)
+    term_ids = np.array(term_ids, dtype=np.int64)
+    order = np.argsort(term_ids, kind="stable")
+    offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)))
+
+    arrays = {
+        "term_offsets": offsets,
+        "postings": np.array(doc_ids, dtype=np.int32)[order],
+        "term_counts": np.minimum(np.array(counts, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)[order],
+        "doc_lengths": np.array(doc_lengths, dtype=np.int32),
+    }
+
+    os.makedirs(index_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(index_dir, name + ".npy"), array)
+    # Vocabulary last: it marks the index as complete
+    tmp_file = os.path.join(index_dir, "vocabulary.json.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump({"token_pattern": TOKEN_PATTERN, "terms": list(vocabulary)}, f)
+    os.replace(tmp_file, os.path.join(index_dir, "vocabulary.json"))
+
+# --------------------------------------------------
+# Is there a complete lexical index in index_dir?
+# --------------------------------------------------
+def lexical_index_exists(index_dir):
+    return all(os.path.exists(os.path.join(index_dir, name + ".npy")) for name in _FILES) \
+        and os.path.exists(os.path.join(index_dir, "vocabulary.json"))
+
+# --------------------------------------------------
+# Read-only BM25 index (arrays memory-mapped)
+# --------------------------------------------------
+class LexicalIndex:
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "vocabulary.json"), "r") as f:
+            saved = json.load(f)
+        self.pattern = re.compile(saved["token_pattern"])
+        self.vocabulary = {term: i for i, term in enumerate(saved["terms"])}
+        for name in _FILES:
+            setattr(self, name, np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r"))
+        self.average_length = max(float(np.mean(self.doc_lengths)), 1.0) if len(self.doc_lengths) else 1.0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    # --------------------------------------------------
+    # Top k chunks for a text query by BM25 score.
+    # mask (from year_mask) limits the results to the
+    # selected IDs.
+    # Returns (scores, ids), best first: only chunks
+    # containing at least one query term are returned.
+    # --------------------------------------------------
+    def search(self, query, k, mask=None, k1=BM25_K1, b=BM25_B):
+        # Stopwords and unknown terms are not in the vocabulary
+        term_ids = {self.vocabulary[t] for t in self.pattern.findall(query.lower()) if t in self.vocabulary}
+        if not term_ids or k <= 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        n_docs = len(self)
+        ids, weights = [], []
+        for t in term_ids:
+            start, end = self.term_offsets[t], self.term_offsets[t + 1]
+            docs = np.asarray(self.postings[start:end])
+            tf = np.asarray(self.term_counts[start:end], dtype=np.float32)
+            idf = np.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = k1 * (1.0 - b + b * self.doc_lengths[docs] / self.average_length)
+            ids.append(docs)
+            weights.append(idf * tf * (k1 + 1.0) / (tf + norm))
+
+        # Sum the scores of chunks matching several terms
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        if mask is not None:
+            keep = mask[ids]
+            ids, scores = ids[keep], scores[keep]
+
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return scores[order], ids[order].astype(np.int64)
+
+# --------------------------------------------------
+# Open the lexical index in index_dir (None if there
+# isn't one)
+# --------------------------------------------------
+def open_lexical_index(index_dir):
+    return LexicalIndex(index_dir) if lexical_index_exists(index_dir) else None
+
+# --------------------------------------------------
+# Reciprocal rank fusion of several rankings (lists
+# of IDs, best first): each ID scores the sum of
+# 1 / (k + rank) over the rankings it appears in.
+# Returns (scores, ids), best first.
+# --------------------------------------------------
+def rrf_fuse(rankings, k=RRF_K):
+    scores = Counter()
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, start=1):
+            scores[int(idx)] += 1.0 / (k + rank)
+    fused = scores.most_common()
+    return (np.array([s for _, s in fused], dtype=np.float32),
+            np.array([i for i, _ in fused], dtype=np.int64))
@@ -0,0 +1,65 @@
+# ==================================================================
+# Micro-batching for the query service: requests arriving from many
+# threads at about the same time are collected (for up to `window`
+# seconds, or until max_batch have arrived) and processed together
+# in one call, e.g. one model.encode and index search for the batch
+# instead of one per request.
+# ==================================================================
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from assistant_config import SERVER_BATCH_WINDOW, SERVER_MAX_BATCH
+
+class MicroBatcher:
+
+    # fn(items) -> list of results, one per item
+    def __init__(self, fn, window=SERVER_BATCH_WINDOW, max_batch=SERVER_MAX_BATCH, name="batcher"):
+        self.fn = fn
+        self.window = window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    # --------------------------------------------------
+    # Process one item (batched with any others
+    # submitted meanwhile) and return its result,
+    # or raise the batch's error
+    # --------------------------------------------------
+    def submit(self, item):
+        future = Future()
+        self.requests.put((item, future))
+        return future.result()
+
+    # --------------------------------------------------
+    # Average number of items per batch so far
+    # --------------------------------------------------
+    def mean_batch_size(self):
+        return self.items / self.batches if self.batches else 0.0
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.items += len(batch)
+            try:
+                results = self.fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
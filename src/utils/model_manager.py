@@ -0,0 +1,109 @@
+# ==================================================================
+# Loads the assistant's models lazily, exactly once per process, and
+# shares them between retrieval-only and RAG modes.
+# start_warmup() loads them on a background thread (e.g. while the
+# user types their first question); get_model() returns a model,
+# waiting for the warm-up or loading it itself if needed.
+# With MODEL_PRECISION = "int8", the linear layers of the models are
+# dynamically quantised (int8 weights, activations quantised on the
+# fly) for faster CPU inference. Documents are always embedded in
+# fp32 for the index, so the index and embedding store don't depend
+# on the setting; only queries are embedded with the int8 model.
+# ==================================================================
+
+import threading
+from assistant_config import EMBEDDING_MODEL, MODEL_PRECISION
+
+PRECISIONS = ["fp32", "int8"]
+
+_models = {}
+_locks = {"embedding": threading.Lock(), "summariser": threading.Lock(), "index_embedding": threading.Lock()}
+
+# --------------------------------------------------
+# Raise an error for an unknown MODEL_PRECISION
+# --------------------------------------------------
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown model precision '{precision}' (use one of {PRECISIONS})")
+
+# --------------------------------------------------
+# Dynamically quantise the linear layers of a torch
+# model to int8 (in place of the fp32 layers)
+# --------------------------------------------------
+def quantise_model(model):
+    import torch
+
+    # fbgemm (x86) if available, otherwise qnnpack (ARM)
+    engines = torch.backends.quantized.supported_engines
+    if "fbgemm" not in engines and "qnnpack" in engines:
+        torch.backends.quantized.engine = "qnnpack"
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# --------------------------------------------------
+# Loaders (imports are done here so that nothing
+# heavy is loaded until a model is needed)
+# --------------------------------------------------
+def load_embedding_model(precision=MODEL_PRECISION):
+    from sentence_transformers import SentenceTransformer
+    check_precision(precision)
+    model = SentenceTransformer(EMBEDDING_MODEL, device="cpu" if precision == "int8" else None)
+    return quantise_model(model) if precision == "int8" else model
+
+def load_summariser_model(precision=MODEL_PRECISION):
+    from utils.retrieval_helpers import load_summariser
+    check_precision(precision)
+    summariser = load_summariser()
+    if precision == "int8":
+        summariser.model = quantise_model(summariser.model)
+    return summariser
+
+_LOADERS = {
+    "embedding": load_embedding_model,
+    "summariser": load_summariser_model,
+    "index_embedding": lambda: load_embedding_model("fp32"),
+}
+
+# --------------------------------------------------
+# Get a model by name ("embedding" or "summariser"),
+# loading it on first use. Concurrent callers wait
+# for the one load rather than starting their own.
+# --------------------------------------------------
+def get_model(name):
+    if name in _models:
+        return _models[name]
+    with _locks[name]:
+        if name not in _models:
+            _models[name] = _LOADERS[name]()
+    return _models[name]
+
+def get_embedding_model():
+    return get_model("embedding")
+
+def get_summariser():
+    return get_model("summariser")
+
+# --------------------------------------------------
+# Embedding model for building the index: always
+# fp32 (the same model as for queries unless
+# MODEL_PRECISION is int8)
+# --------------------------------------------------
+def get_index_embedding_model():
+    return get_model("embedding" if MODEL_PRECISION == "fp32" else "index_embedding")
+
+# --------------------------------------------------
+# Start loading models on a background thread.
+# Errors are left for get_model() to raise when the
+# model is actually needed.
+# --------------------------------------------------
+def start_warmup(names=("embedding", "summariser")):
+    def warm():
+        for name in names:
+            try:
+                get_model(name)
+            except Exception as e:
+                print(f"[Warning] Could not preload {name} model: {e}")
+
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
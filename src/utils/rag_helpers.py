@@ -4,23 +4,69 @@
 # Author: Katharine Leney, April 2025
 # ===========================================
 
-import openai
-import numpy as np
 import os
-from assistant_config import RAG_MODEL
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+from collections import Counter
+from assistant_config import TOP_K, RAG_MODEL, RAG_CONCURRENCY, RAG_TIMEOUT, RAG_RETRIES, RAG_BACKOFF
+from assistant_config import RAG_TEMPERATURE, RAG_MAX_TOKENS
+from assistant_config import LLM_CACHE, LLM_CACHE_DIR, LLM_CACHE_TTL_DAYS, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_EVICT_TO
+from utils.index_helpers import retrieve, year_mask
+from utils.context_packer import pack_context
+from utils.tracing import trace_stage
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# min_year, max_year, exclude_years = only retrieve chunks
+# from those years (needs the years of your_documents)
+# stream = print the answer to the terminal as it arrives
+# verbose = print how the context was packed
+def handle_query_with_rag(query, model, faiss_index, your_documents, k=TOP_K, years=None,
+                          min_year=None, max_year=None, exclude_years=None, query_embedding=None,
+                          stream=False, verbose=False):
+    return handle_queries_with_rag([query], model, faiss_index, your_documents, k=k, years=years,
+                                   min_year=min_year, max_year=max_year, exclude_years=exclude_years,
+                                   query_embeddings=None if query_embedding is None else query_embedding[None, :],
+                                   stream=stream, verbose=verbose)[0]
 
-def handle_query_with_rag(query, model, faiss_index, your_documents, k=5):
-    # Embed the query
-    query_embedding = model.encode(query)
+# As handle_query_with_rag, for a list of queries: the
+# queries are embedded and searched in a single batch,
+# then answered concurrently (query_embeddings = already encoded)
+def handle_queries_with_rag(queries, model, faiss_index, your_documents, k=TOP_K, years=None,
+                            min_year=None, max_year=None, exclude_years=None, query_embeddings=None,
+                            stream=False, verbose=False):
+    mask = None
+    if min_year is not None or max_year is not None or exclude_years:
+        if years is None:
+            raise ValueError("years must be given to filter by year.")
+        mask = year_mask(years, min_year, max_year, exclude_years)
 
-    # Retrieve top-k relevant chunks
-    D, I = faiss_index.search(np.array([query_embedding]), k)
-    retrieved_chunks = [your_documents[i] for i in I[0]]
+    # Embed the queries and retrieve top-k relevant chunks
+    hits = retrieve(model, faiss_index, queries, k, mask=mask, query_embeddings=query_embeddings)
 
-    # Build the context
-    context = "\n\n".join(retrieved_chunks)
+    # Pack the best of the k candidates into the context token budget
+    chunk_lists = []
+    for D, I in hits:
+        with trace_stage("pack_context", items=len(I)) as stage:
+            chunks, stats = pack_context(D, I, your_documents)
+            stage.set(context_tokens=stats["context_tokens"])
+        chunk_lists.append(chunks)
+        if verbose:
+            print_packing(stats)
+
+    if stream:
+        return [stream_answer(query, chunks) for query, chunks in zip(queries, chunk_lists)]
+    return [answer for answer, _ in run_async(agenerate_answers(queries, chunk_lists))]
+
+# Report on the context packed for a query
+def print_packing(stats):
+    print(f"[Context: {stats['chunks']} of {stats['candidates']} retrieved chunks, "
+          f"{stats['context_tokens']} tokens ({stats['tokens_saved']} saved)]")
+
+# Prompt and messages sent to the LLM for a query
+def build_messages(query, context):
     prompt = f"""Answer the question below using only the context provided.
                 If you cannot find an answer, say "Based on the provided context, there is no clear answer."
 
@@ -32,24 +78,288 @@ def handle_query_with_rag(query, model, faiss_index, your_documents, k=5):
 
                 Answer:
             """
+    return [
+        {"role": "system", "content": "You are a helpful aviation industry assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+# --------------------------------------------------
+# Disk cache of LLM answers: one JSON file per request,
+# keyed by a hash of everything that determines the
+# answer (model, temperature, max_tokens and messages,
+# which include the system message and full prompt).
+# Entries expire LLM_CACHE_TTL_DAYS after they were
+# created (stored in the entry: the file's mtime is
+# the time of last use, for LRU), and the
+# least recently used are removed beyond
+# LLM_CACHE_MAX_ENTRIES (checked against a running
+# count, so a put doesn't list the whole cache).
+# --------------------------------------------------
+llm_cache_stats = Counter()
 
-    # Generate answer using OpenAI
+def llm_cache_key(model, temperature, max_tokens, messages):
+    request = json.dumps([model, temperature, max_tokens, messages], sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+def _llm_cache_path(key):
+    return os.path.join(LLM_CACHE_DIR, key + ".json")
+
+# Cached answer for a key, or None
+def llm_cache_get(key):
+    path = _llm_cache_path(key)
     try:
-        response = client.chat.completions.create(
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # (another process may have removed the entry meanwhile)
+    if time.time() - entry["created"] > LLM_CACHE_TTL_DAYS * 86400:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    # Mark as recently used
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return entry["answer"]
+
+# Number of entries in the cache, as of the last scan
+# by evict_llm_cache plus the entries added since
+# (None = not scanned yet in this process)
+_llm_cache_entries = None
+
+def llm_cache_put(key, answer):
+    global _llm_cache_entries
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    path = _llm_cache_path(key)
+    is_new = not os.path.exists(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"created": time.time(), "model": RAG_MODEL, "answer": answer}, f)
+    os.replace(tmp_path, path)
+
+    # The directory is only scanned when the count of entries
+    # says the cache is over capacity (or on the first put)
+    if _llm_cache_entries is None or (_llm_cache_entries + is_new > LLM_CACHE_MAX_ENTRIES):
+        evict_llm_cache()
+    else:
+        _llm_cache_entries += is_new
+
+# Creation time of a cache entry (None if it can't
+# be read)
+def _llm_cache_created(path):
+    try:
+        with open(path, "r") as f:
+            return float(json.load(f)["created"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+# Remove expired (and unreadable) entries, then the
+# least recently used beyond max_entries, down to
+# LLM_CACHE_EVICT_TO of it (so a full cache isn't
+# scanned again on every put)
+def evict_llm_cache(max_entries=LLM_CACHE_MAX_ENTRIES, ttl_days=LLM_CACHE_TTL_DAYS):
+    global _llm_cache_entries
+    if not os.path.isdir(LLM_CACHE_DIR):
+        _llm_cache_entries = 0
+        return
+    entries = []
+    now = time.time()
+    # (entries removed by another process are skipped)
+    for entry in os.scandir(LLM_CACHE_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            last_used = entry.stat().st_mtime
+            created = _llm_cache_created(entry.path)
+            if created is None or now - created > ttl_days * 86400:
+                os.remove(entry.path)
+                continue
+        except FileNotFoundError:
+            continue
+        entries.append((last_used, entry.path))
+    if len(entries) > max_entries:
+        keep = int(max_entries * LLM_CACHE_EVICT_TO)
+        for _, path in sorted(entries)[:len(entries) - keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        del entries[keep:]
+    _llm_cache_entries = len(entries)
+
+# --------------------------------------------------
+# Async RAG: answers are streamed from the API, with
+# at most RAG_CONCURRENCY requests in flight, a
+# RAG_TIMEOUT (seconds) per attempt, and up to
+# RAG_RETRIES retries with exponential backoff before
+# falling back to the retrieved context.
+# The client honours OPENAI_BASE_URL, so it can be
+# pointed at a local OpenAI-compatible server (e.g.
+# src/openai_stub_server.py).
+# --------------------------------------------------
+_async_clients = {}
+
+# One client per event loop (its connections can't be
+# shared across the loops made by asyncio.run)
+def get_async_client():
+    # Imported here, so openai is only loaded in RAG mode
+    import openai
+
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        # (retries are handled here, so that streamed
+        # attempts are retried too)
+        _async_clients[loop] = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _async_clients[loop]
+
+# Close the running loop's client (if it made one),
+# while the loop its connections belong to is still open
+async def close_async_client():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+# asyncio.run(coro), closing the client made in that
+# run before its event loop goes away
+def run_async(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await close_async_client()
+    return asyncio.run(main())
+
+# Stream one completion, calling on_token(text) for
+# each piece as it arrives (traced with the number of
+# pieces and the time to the first)
+async def _stream_completion(messages, on_token=None):
+    with trace_stage("llm_request") as stage:
+        t0 = time.perf_counter()
+        stream = await get_async_client().chat.completions.create(
             model=RAG_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a helpful aviation industry assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,
-            max_tokens=500
+            messages=messages,
+            temperature=RAG_TEMPERATURE,
+            max_tokens=RAG_MAX_TOKENS,
+            stream=True
         )
-        answer = response.choices[0].message.content
-    except Exception as e:
-        print(f"[Warning] Generation failed: {e}")
-        answer = None
+        pieces = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                if not pieces:
+                    stage.set(first_token_s=round(time.perf_counter() - t0, 4))
+                pieces.append(token)
+                if on_token is not None:
+                    on_token(token)
+        stage.set(items=len(pieces))
+    return "".join(pieces)
+
+# Answer a query from the retrieved chunks
+# semaphore = shared limit on concurrent requests
+# on_token(text) = called as the answer streams in
+# use_cache = reuse (and store) answers in the disk cache
+async def agenerate_answer(query, retrieved_chunks, semaphore=None, on_token=None,
+                           timeout=RAG_TIMEOUT, retries=RAG_RETRIES, backoff=RAG_BACKOFF,
+                           use_cache=LLM_CACHE):
+    import openai
+
+    context = "\n\n".join(retrieved_chunks)
+    messages = build_messages(query, context)
+    semaphore = semaphore or asyncio.Semaphore(1)
+
+    if use_cache:
+        key = llm_cache_key(RAG_MODEL, RAG_TEMPERATURE, RAG_MAX_TOKENS, messages)
+        with trace_stage("llm_cache_lookup") as stage:
+            answer = llm_cache_get(key)
+            stage.set(hit=bool(answer))
+        if answer:
+            llm_cache_stats["hits"] += 1
+            if on_token is not None:
+                on_token(answer)
+            return answer
+        llm_cache_stats["misses"] += 1
+
+    # Tokens passed to on_token by the current attempt: a
+    # retry starts the answer again from the beginning, so
+    # if part of it was already shown, say so
+    shown = []
+    def show_token(token):
+        shown.append(token)
+        on_token(token)
+
+    answer = None
+    for attempt in range(retries + 1):
+        if attempt:
+            if shown:
+                on_token(f"\n[Answer interrupted: starting again (retry {attempt}/{retries})]\n")
+                shown.clear()
+            # Exponential backoff with jitter, outside the
+            # semaphore so other queries can use the slot
+            await asyncio.sleep(backoff * 2 ** (attempt - 1) * (0.5 + random.random()))
+        try:
+            async with semaphore:
+                answer = await asyncio.wait_for(
+                    _stream_completion(messages, show_token if on_token is not None else None), timeout)
+            break
+        except asyncio.TimeoutError:
+            print(f"[Warning] Generation timed out after {timeout}s")
+        except openai.APIStatusError as e:
+            print(f"[Warning] Generation failed: {e}")
+            # Client errors (bad request, auth...) won't be fixed by retrying
+            if e.status_code < 500 and e.status_code not in (408, 409, 429):
+                break
+        except Exception as e:
+            # Anything else (connection errors, including the stream
+            # being cut off part way through) is retried
+            print(f"[Warning] Generation failed: {type(e).__name__}: {e}")
 
     if answer:
+        if use_cache:
+            llm_cache_put(key, answer)
         return answer
     else:
-        return f"[Fallback] Retrieved context:\n{context}"
\ No newline at end of file
+        if shown:
+            on_token("\n[Answer interrupted]\n")
+        return f"[Fallback] Retrieved context:\n{context}"
+
+# Answer several queries concurrently from their
+# retrieved chunks (chunk_lists[i] for queries[i]).
+# Returns the answers and the time each took.
+async def agenerate_answers(queries, chunk_lists, concurrency=RAG_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(query, chunks):
+        t0 = time.perf_counter()
+        answer = await agenerate_answer(query, chunks, semaphore)
+        return answer, time.perf_counter() - t0
+
+    return await asyncio.gather(*(timed(q, c) for q, c in zip(queries, chunk_lists)))
+
+# Answer a query, printing the answer to the terminal
+# as it streams in. Returns the full answer.
+def stream_answer(query, retrieved_chunks):
+    def print_token(token):
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    answer = run_async(agenerate_answer(query, retrieved_chunks, on_token=print_token))
+    if answer.startswith("[Fallback]"):
+        print(answer)
+    else:
+        print()
+    return answer
+
+# Pre-warm the disk cache with answers to a list of
+# queries (e.g. the standard question set), so that
+# later runs of them need no API calls
+def warm_llm_cache(queries, model, faiss_index, your_documents, **kwargs):
+    llm_cache_stats.clear()
+    handle_queries_with_rag(queries, model, faiss_index, your_documents, **kwargs)
+    print(f"LLM cache: {llm_cache_stats['hits']} of {len(queries)} answers already cached, "
+          f"{llm_cache_stats['misses']} generated")
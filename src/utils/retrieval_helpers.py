@@ -4,63 +4,59 @@
 # ==================================================================
 
 import numpy as np
-from transformers import pipeline
-from assistant_config import SUMMARISER_MODEL, THRESHOLD, TOP_K
+from assistant_config import SUMMARISER_MODEL, TOP_K
+from assistant_config import SUMMARISER_BATCH_SIZE, SUMMARY_MAP_LENGTH, SUMMARY_MAX_LENGTH, SUMMARY_MAX_CHARS
+from utils.index_helpers import retrieve, year_mask
+from utils.index_helpers import dynamic_top_k  # (moved to index_helpers: imported from here by older code)
+from utils.tracing import trace_stage
 
 # --------------------------------------------------
-# Function to dynamically determine optimal number
-# of documents to summarise, based on distance jumps
-# threshold = minimum jump size to consider a 'gap'
+# Function to retrieve most relevant chunks 
+# of text related to user query
+# min_year, max_year, exclude_years = only search
+# chunks from those years (as filter_dataframe_by_year)
 # --------------------------------------------------
-def dynamic_top_k(distances, threshold=THRESHOLD):
 
-    distances = np.array(distances)
-    diffs = np.diff(distances)
-
-    for idx, diff in enumerate(diffs):
-        #print(idx, ": Distance = ", distances[idx], " : Difference wrt next element: ", diffs[idx])
-        if diff > threshold:
-            #print ("Keeping ", idx+1, " text elements for summarising")
-            return idx + 1 
-        
-    #print("No large gap found. Keeping all ", len(distances), "matches")
-    return len(distances)
+def ask_question(model, index, texts, years, query, top_k=TOP_K, verbose=False,
+                 min_year=None, max_year=None, exclude_years=None, query_embedding=None):
 
+    return ask_questions(model, index, texts, years, [query], top_k=top_k, verbose=verbose,
+                         min_year=min_year, max_year=max_year, exclude_years=exclude_years,
+                         query_embeddings=None if query_embedding is None else query_embedding[None, :])[0]
 
 # --------------------------------------------------
-# Function to retrieve most relevant chunks 
-# of text related to user query
+# As ask_question, for a list of queries, encoded and
+# searched in a single batch (query_embeddings =
+# already encoded).
+# Returns a list of results for each query.
 # --------------------------------------------------
+def ask_questions(model, index, texts, years, queries, top_k=TOP_K, verbose=False,
+                  min_year=None, max_year=None, exclude_years=None, query_embeddings=None):
 
-def ask_question(model, index, texts, years, query, top_k=TOP_K, verbose=False):
+    # D = distance (similarity) scores between each query and its top_n matches
+    # I = Indices of the top_n closest matches to each query
+    # (approximate indexes may return fewer than top_n matches)
+    mask = year_mask(years, min_year, max_year, exclude_years)
+    hits = retrieve(model, index, queries, top_k, mask=mask, query_embeddings=query_embeddings)
 
-    query_embedding = model.encode([query], convert_to_numpy=True)
+    return [rank_results(D, I, texts, years, verbose=verbose) for D, I in hits]
 
-    # D = distance (similarity) scores between query and top_n matches
-    # I = Indices of the top_n closest matches to the query
-    # Arrays, with shape (number of queries (1!), top_n)
-    D, I = index.search(query_embedding, top_k)
+# --------------------------------------------------
+# Turn the distances and indices of the matches to
+# one query into (text, year) results
+# --------------------------------------------------
+def rank_results(D, I, texts, years, verbose=False):
 
     # Pair distance, text, and year
-    results = [(dist, texts[idx], years[idx]) for idx, dist in zip(I[0], D[0])]
-    
-    # Sort by distance (lower = better match)
-    results = sorted(results, key=lambda x: x[0])
-
-    # Dynamically decide how many matches to keep
-    # based on distance gap between elements
-    dynamic_decision = True
-    if dynamic_decision :
-        selected_k = dynamic_top_k(D[0])
+    # (matches come from retrieve best first, already cut
+    # at the first large distance gap, so their order is kept:
+    # with hybrid search it is the fused rank, not the distance)
+    results = [(dist, texts[idx], years[idx]) for idx, dist in zip(I, D)]
 
-        # Select top selected_k results
-        D = D[:, :selected_k]
-        I = I[:, :selected_k]
-
-    # If verbose mode, print the distance, year, and text snippet of top 5 matches.
+    # If verbose mode, print the distance, year, and text snippet of the kept matches.
     if verbose:
         print("\nTop Matches (Distance Scores):")
-        for rank, (dist, text, year) in enumerate(results[:D[0].size], start=1):
+        for rank, (dist, text, year) in enumerate(results, start=1):
             snippet = text[:50].replace('\n', ' ').strip() + ("..." if len(text) > 50 else "")
             print(f"{rank}. Distance: {dist:.4f} | Year: {year} | Text Snippet: \"{snippet}\"")
 
@@ -74,7 +70,11 @@ def ask_question(model, index, texts, years, query, top_k=TOP_K, verbose=False):
 # for condensing retrieved texts
 # --------------------------------------------------
 def load_summariser():
-    summariser = pipeline("summarization", model=SUMMARISER_MODEL, tokenizer=SUMMARISER_MODEL, framework="pt")
+    # Imported here, as transformers is slow to import
+    # and only needed in retrieval-only mode
+    with trace_stage("load_summariser"):
+        from transformers import pipeline
+        summariser = pipeline("summarization", model=SUMMARISER_MODEL, tokenizer=SUMMARISER_MODEL, framework="pt")
     return summariser
 
 
@@ -98,10 +98,120 @@ def summarise_texts(texts, summariser):
         concatenated = concatenated[:2000]
 
     prompt = "summarize: " + concatenated
-    summary = summariser(prompt, max_length=150, min_length=30, do_sample=False)[0]['summary_text']
+    with trace_stage("summarise", items=1):
+        summary = summariser(prompt, max_length=150, min_length=30, do_sample=False)[0]['summary_text']
     #summary = summariser(prompt)[0]['summary_text']
     return summary
 
+# --------------------------------------------------
+# Summarise each text on its own, in one batched
+# pipeline call (texts under 30 words are kept as
+# they are, as in summarise_texts)
+# --------------------------------------------------
+def summarise_batch(texts, summariser, max_length, batch_size=SUMMARISER_BATCH_SIZE):
+
+    summaries = [text.strip() for text in texts]
+    todo = [i for i, text in enumerate(texts) if len(text.split()) >= 30]
+    if todo:
+        prompts = ["summarize: " + texts[i][:SUMMARY_MAX_CHARS] for i in todo]
+        with trace_stage("summarise_batch", items=len(prompts), max_length=max_length):
+            outputs = summariser(prompts, max_length=max_length, min_length=min(30, max_length // 2),
+                                 do_sample=False, truncation=True, batch_size=batch_size)
+        for i, output in zip(todo, outputs):
+            summaries[i] = output["summary_text"]
+    return summaries
+
+# --------------------------------------------------
+# Join texts into as few groups as possible of at
+# most max_chars characters each
+# --------------------------------------------------
+def group_texts(texts, max_chars=SUMMARY_MAX_CHARS):
+
+    groups = []
+    for text in texts:
+        if groups and len(groups[-1]) + 1 + len(text) <= max_chars:
+            groups[-1] += " " + text
+        else:
+            groups.append(text)
+    return groups
+
+# --------------------------------------------------
+# Join one or two texts into a single text of at
+# most max_chars characters, giving each half of it
+# --------------------------------------------------
+def pair_texts(texts, max_chars=SUMMARY_MAX_CHARS):
+
+    if len(texts) == 1:
+        return texts[0]
+    half = (max_chars - 1) // 2
+    return " ".join(text[:half] for text in texts)
+
+# --------------------------------------------------
+# Map-reduce summarisation of the snippets retrieved
+# for several queries (text_lists = one list of
+# snippets per query), so that every snippet shapes
+# the answer rather than just the first one or two:
+#  map    : each snippet is summarised on its own, all
+#           of them in one batched pipeline call
+#  reduce : each query's partial summaries are joined
+#           and summarised into the answer (in rounds,
+#           while they are longer than SUMMARY_MAX_CHARS:
+#           every round at least halves their number)
+# Each round is one batched call across all queries.
+# Returns one answer per query.
+# --------------------------------------------------
+def summarise_map_reduce(text_lists, summariser, batch_size=SUMMARISER_BATCH_SIZE):
+
+    # Map
+    snippets = [text for texts in text_lists for text in texts]
+    with trace_stage("summarise_map", items=len(snippets)):
+        partials = summarise_batch(snippets, summariser, SUMMARY_MAP_LENGTH, batch_size)
+    pending, start = {}, 0
+    for q, texts in enumerate(text_lists):
+        pending[q] = partials[start:start + len(texts)]
+        start += len(texts)
+
+    # Reduce
+    answers = ["No relevant information found."] * len(text_lists)
+    with trace_stage("summarise_reduce", items=len(text_lists)) as stage:
+        rounds = 0
+        while pending:
+            rounds += 1
+            final, intermediate = {}, {}
+            for q, parts in pending.items():
+                groups = group_texts(parts)
+                if len(groups) == 1:
+                    final[q] = groups[0]
+                    continue
+                if len(groups) == len(parts):
+                    # No two neighbouring parts fit together: summarise them
+                    # in pairs (each cut to half of SUMMARY_MAX_CHARS, so that
+                    # both are read), which still halves their number
+                    groups = [pair_texts(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+                intermediate[q] = groups
+
+            if final:
+                summaries = summarise_batch(list(final.values()), summariser, SUMMARY_MAX_LENGTH, batch_size)
+                for q, summary in zip(final, summaries):
+                    if summary:
+                        answers[q] = summary
+
+            flat = [group for groups in intermediate.values() for group in groups]
+            summaries = summarise_batch(flat, summariser, SUMMARY_MAP_LENGTH, batch_size) if flat else []
+            pending, start = {}, 0
+            for q, groups in intermediate.items():
+                pending[q] = summaries[start:start + len(groups)]
+                start += len(groups)
+        stage.set(rounds=rounds)
+
+    return answers
+
+# --------------------------------------------------
+# Map-reduce summary of the snippets for one query
+# --------------------------------------------------
+def summarise_texts_map_reduce(texts, summariser):
+    return summarise_map_reduce([texts], summariser)[0]
+
 # --------------------------------------------------
 # Improved handling of text in summariser model.
 # Tells the summariser to handle all provided text
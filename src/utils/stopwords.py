@@ -1,5 +1,9 @@
 from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
 
+# Token pattern for the vectorizers and the lexical index:
+# any word- or hyphen-chars, length >= 2, but at least one letter
+TOKEN_PATTERN = r"(?u)\b(?=\w*[A-Za-z])[\w-]{2,}\b"
+
 # Expand list of stopwords to remove industry-specific noise
 # and months of the year
 iata_stopwords = [
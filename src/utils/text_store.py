@@ -0,0 +1,118 @@
+# ==================================================================
+# On-disk store of the chunk texts and years behind the FAISS index.
+# Texts are concatenated UTF-8 in one binary file, with an array of
+# byte offsets, so any chunk can be read by its index ID without
+# loading the rest. Both files (and the years) are memory-mapped,
+# so opening the store costs the same whatever the corpus size.
+#
+# Layout: the index version directory (see utils/index_versions.py)
+#    texts.bin         : UTF-8 text of every chunk, back to back
+#    texts_offsets.npy : int64 start offset of each chunk (plus the end)
+#    years.npy         : int16 year of each chunk (0 = unknown)
+# ==================================================================
+
+import os
+import mmap
+import json
+import shutil
+import numpy as np
+from assistant_config import TEXTS_FILE_NAME, TEXT_OFFSETS_FILE_NAME, YEARS_FILE_NAME, LEGACY_TEXTS_FILE_NAME
+
+_FILES = (TEXTS_FILE_NAME, TEXT_OFFSETS_FILE_NAME, YEARS_FILE_NAME)
+
+# --------------------------------------------------
+# Year labels ("2019", "unknown", ...) as integers
+# --------------------------------------------------
+def year_to_int(year):
+    year = str(year)
+    return int(year) if year.isdigit() else 0
+
+# --------------------------------------------------
+# Write the texts and years of the indexed chunks
+# (row i of the index is chunk i) to store_dir
+# --------------------------------------------------
+def write_text_store(texts, years, store_dir):
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    with open(os.path.join(store_dir, TEXTS_FILE_NAME), "wb") as f:
+        for i, text in enumerate(texts):
+            data = text.encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(store_dir, TEXT_OFFSETS_FILE_NAME), offsets)
+    np.save(os.path.join(store_dir, YEARS_FILE_NAME), np.array([year_to_int(y) for y in years], dtype=np.int16))
+
+# --------------------------------------------------
+# Read-only, list-like view of the texts: texts[i]
+# reads and decodes just chunk i from the mapped file
+# --------------------------------------------------
+class TextStore:
+
+    def __init__(self, store_dir):
+        self.directory = store_dir
+        self.offsets = np.load(os.path.join(store_dir, TEXT_OFFSETS_FILE_NAME), mmap_mode="r")
+        texts_file = os.path.join(store_dir, TEXTS_FILE_NAME)
+        with open(texts_file, "rb") as f:
+            # (mmap can't map an empty file)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(texts_file) else b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("text index out of range")
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+# --------------------------------------------------
+# Is there a text store in store_dir? (only checks:
+# see convert_legacy_text_store for older builds)
+# --------------------------------------------------
+def text_store_exists(store_dir):
+    return all(os.path.exists(os.path.join(store_dir, name)) for name in _FILES)
+
+# Does store_dir hold the texts_and_years.json of an
+# older build instead?
+def legacy_text_store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, LEGACY_TEXTS_FILE_NAME))
+
+# --------------------------------------------------
+# Convert the texts_and_years.json of an older build
+# in store_dir to the text store. Each file is written
+# under a temporary name and renamed into place, the
+# years last, so a process that finds all of them
+# (text_store_exists) never reads a partial file, and
+# two processes converting at once write the same files.
+# --------------------------------------------------
+def convert_legacy_text_store(store_dir):
+    legacy_file = os.path.join(store_dir, LEGACY_TEXTS_FILE_NAME)
+    print("Converting texts_and_years.json to the text store...")
+    with open(legacy_file, "r") as f:
+        saved = json.load(f)
+
+    tmp_dir = os.path.join(store_dir, f".text_store.{os.getpid()}.tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        write_text_store([item["text"] for item in saved], [item["year"] for item in saved], tmp_dir)
+        for name in _FILES:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(store_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    try:
+        os.remove(legacy_file)
+    except FileNotFoundError:
+        pass  # removed by another process converting it too
+
+# --------------------------------------------------
+# Open the store in store_dir: returns (texts, years),
+# where texts is a TextStore and years a memory-mapped
+# int16 array
+# --------------------------------------------------
+def open_text_store(store_dir):
+    return TextStore(store_dir), np.load(os.path.join(store_dir, YEARS_FILE_NAME), mmap_mode="r")
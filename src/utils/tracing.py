@@ -0,0 +1,251 @@
+# ==================================================================
+# Lightweight per-stage tracing of the pipeline (PDF parsing,
+# chunking, embedding, FAISS and BM25 search, summarisation, LLM
+# calls...), switched on with --profile.
+# Code marks its stages with
+#    with trace_stage("faiss_search", items=len(queries)) as stage:
+#        ...
+#        stage.set(results=n)     # (optional extra fields)
+# and each completed stage is written as one line of a JSONL trace:
+#    stage      : name of the stage
+#    start_s    : start, in seconds since tracing began
+#    duration_s : wall time of the stage
+#    self_s     : duration_s minus that of the stages nested in it
+#    items      : number of items processed (queries, pages, chunks...)
+#    peak_rss_mb: peak resident memory of the process at the end
+#    rss_growth_mb : how much the stage raised that peak
+#    parent     : enclosing stage (if any), error (if it raised)
+# plus any extra fields. finish_trace() prints p50/p95/p99 durations
+# per stage and writes them to <trace>_summary.json.
+# When tracing is off, trace_stage returns a shared do-nothing
+# object, so instrumented code pays one function call per stage.
+# Nesting follows contextvars, so it is tracked separately for each
+# thread and asyncio task.
+# ==================================================================
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextvars
+import numpy as np
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError:  # (Windows)
+    resource = None
+
+_trace = None
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+# --------------------------------------------------
+# Peak resident memory of the process so far, in MB
+# (None where it can't be read)
+# --------------------------------------------------
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (bytes on macOS, kilobytes elsewhere)
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+class _Trace:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = defaultdict(list)
+
+    def record(self, record):
+        line = json.dumps(record)
+        with self.lock:
+            self.stages[record["stage"]].append(record)
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+class _Stage:
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.child_s = 0.0
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.parent = _current_stage.get()
+        self.token = _current_stage.set(self)
+        self.rss = peak_rss_mb()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.t0
+        _current_stage.reset(self.token)
+        if self.parent is not None:
+            self.parent.child_s += duration
+        _record(self.name, self.t0, duration, duration - self.child_s, self.rss, self.parent,
+                self.fields, error=None if exc_type is None else exc_type.__name__)
+        return False
+
+
+class _NoStage:
+
+    def set(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_STAGE = _NoStage()
+
+def _record(name, t0, duration, self_s, rss, parent, fields, error=None):
+    trace = _trace
+    if trace is None:
+        return
+    peak = peak_rss_mb()
+    record = {
+        "stage": name,
+        "start_s": round(t0 - trace.start, 6),
+        "duration_s": round(duration, 6),
+        "self_s": round(self_s, 6),
+        "peak_rss_mb": None if peak is None else round(peak, 1),
+        "rss_growth_mb": None if peak is None else round(peak - rss, 1),
+    }
+    if parent is not None:
+        record["parent"] = parent.name
+    if error is not None:
+        record["error"] = error
+    record.update(fields)
+    trace.record(record)
+
+# --------------------------------------------------
+# Is a trace being recorded?
+# --------------------------------------------------
+def tracing_enabled():
+    return _trace is not None
+
+# --------------------------------------------------
+# Time a stage (use as a context manager)
+# items = number of items the stage processes
+# --------------------------------------------------
+def trace_stage(name, items=None, **fields):
+    if _trace is None:
+        return _NO_STAGE
+    if items is not None:
+        fields["items"] = items
+    return _Stage(name, fields)
+
+# --------------------------------------------------
+# Trace the time spent producing the items of an
+# iterable (e.g. a generator parsing PDF pages that
+# a later stage consumes as it goes): recorded as
+# one stage, with the number of items, once the
+# iterable is exhausted. The time is taken out of
+# the self_s of the stage consuming it.
+# --------------------------------------------------
+def trace_iter(name, items, **fields):
+    if _trace is None:
+        return items
+    return _traced_iter(name, items, fields)
+
+def _traced_iter(name, items, fields):
+    iterator = iter(items)
+    parent = _current_stage.get()
+    rss = peak_rss_mb()
+    t_start = time.perf_counter()
+    duration, n = 0.0, 0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                duration += time.perf_counter() - t0
+            n += 1
+            yield item
+    finally:
+        # (also when the consumer stops early)
+        if parent is not None:
+            parent.child_s += duration
+        _record(name, t_start, duration, duration, rss, parent, dict(fields, items=n))
+
+# --------------------------------------------------
+# Start recording a trace to path (JSONL). The
+# summary is printed and saved by finish_trace(),
+# which also runs at exit.
+# --------------------------------------------------
+def start_trace(path):
+    global _trace
+    finish_trace()
+    _trace = _Trace(path)
+    atexit.register(finish_trace)
+    print(f"Profiling: writing a trace of each stage to {path}")
+
+# --------------------------------------------------
+# Per-stage summary of the trace so far: count,
+# total, p50/p95/p99 duration, items and peak memory
+# --------------------------------------------------
+def summarise_trace(stages):
+    summary = {}
+    for name, records in stages.items():
+        durations = np.array([r["duration_s"] for r in records])
+        items = sum(r.get("items") or 0 for r in records)
+        peaks = [r["peak_rss_mb"] for r in records if r["peak_rss_mb"] is not None]
+        p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+        summary[name] = {
+            "count": len(records),
+            "total_s": round(float(durations.sum()), 4),
+            "self_s": round(sum(r["self_s"] for r in records), 4),
+            "p50_s": round(float(p50), 4),
+            "p95_s": round(float(p95), 4),
+            "p99_s": round(float(p99), 4),
+            "items": items,
+            "items_per_s": round(items / durations.sum(), 1) if items and durations.sum() > 0 else None,
+            "peak_rss_mb": max(peaks) if peaks else None,
+        }
+    return summary
+
+def print_trace_summary(summary):
+    print(f"\n{'Stage':<22}{'Count':>7}{'Total s':>10}{'Self s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'Items':>9}{'Items/s':>10}{'Peak MB':>9}")
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]["self_s"]):
+        items_per_s = "" if s["items_per_s"] is None else f"{s['items_per_s']:.1f}"
+        peak = "" if s["peak_rss_mb"] is None else f"{s['peak_rss_mb']:.0f}"
+        print(f"{name:<22}{s['count']:>7}{s['total_s']:>10.3f}{s['self_s']:>10.3f}{s['p50_s'] * 1000:>10.1f}"
+              f"{s['p95_s'] * 1000:>10.1f}{s['p99_s'] * 1000:>10.1f}{s['items']:>9}{items_per_s:>10}{peak:>9}")
+
+# --------------------------------------------------
+# Stop tracing: print the per-stage summary and
+# write it next to the trace
+# --------------------------------------------------
+def finish_trace():
+    global _trace
+    trace, _trace = _trace, None
+    if trace is None:
+        return
+    trace.file.close()
+    if not trace.stages:
+        print("Profiling: no stages were recorded")
+        return
+
+    summary = summarise_trace(trace.stages)
+    summary_file = os.path.splitext(trace.path)[0] + "_summary.json"
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    print_trace_summary(summary)
+    print(f"\nTrace written to {trace.path}, summary to {summary_file}")